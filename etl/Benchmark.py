@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import threading
+import pandas as pd
+
+# Throughput benchmarks of the ETL pipeline on the datasets written by SyntheticData.py.
+# Every loader and the full main_flow run against a stand-in driver that records the
+# statements instead of writing them, or against the database of NEO4J_URI with --neo4j.
+# Results are compared with a stored baseline so that regressions show up
+
+# The connection of ETLfunctions is only opened by --neo4j runs
+os.environ.setdefault("NEO4J_URI", "neo4j://localhost:7687")
+import ETLfunctions
+import GraphETLpipeline as pipeline
+
+class RecordingConnection:
+    # Stand-in for AsyncNeo4jConnection counting the statements, rows and bytes sent. With
+    # a target connection the statements are also executed, otherwise they take latency seconds
+
+    def __init__(self, target=None, latency=0.0):
+        self.target = target
+        self.latency = latency
+        self.statements = 0
+        self.rows = 0
+        self.bytes_sent = 0
+
+    async def query(self, query, parameters=None, db=None, consume="records"):
+        # Bytes sent are approximated by the statement and its parameters serialised as JSON
+        self.statements += 1
+        self.rows += len((parameters or {}).get("rows", []))
+        self.bytes_sent += len(query.encode()) + len(json.dumps(parameters or {}, default=str).encode())
+        if self.target is not None:
+            return await self.target.query(query, parameters=parameters, db=db, consume=consume)
+        await asyncio.sleep(self.latency)
+        if consume == "both":
+            return [], None
+        return [] if consume == "records" else None
+
+    def counters(self):
+        return self.statements, self.rows, self.bytes_sent
+
+class PeakRss:
+    # Samples the resident set size of the process while a stage runs. ru_maxrss only
+    # holds the peak of the whole process, so /proc is read where it exists
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.__stop = threading.Event()
+
+    def current(self):
+        try:
+            with open("/proc/self/statm") as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def __sample(self):
+        while not self.__stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self.__stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.__stop.set()
+        self.__thread.join()
+        self.peak = max(self.peak, self.current())
+
+async def measure(results: dict, stage: str, recorder: RecordingConnection, coroutine, rows=None):
+    # Runs one stage and stores its wall time, throughput, peak RSS and the traffic it sent
+    before = recorder.counters()
+    with PeakRss() as rss:
+        s = time.perf_counter()
+        await coroutine
+        elapsed = time.perf_counter() - s
+    statements, sent_rows, bytes_sent = [after - start for after, start in zip(recorder.counters(), before)]
+    rows = sent_rows if rows is None else rows
+    results[stage] = {"seconds": round(elapsed, 4), "rows": rows, "rows_per_sec": round(rows / elapsed, 1) if elapsed else 0.0,
+                      "statements": statements, "bytes_sent": bytes_sent, "peak_rss_mb": round(rss.peak / 1024 ** 2, 1)}
+    print(f"{stage}: {results[stage]}")
+
+async def read_dataset(path: str):
+    return await asyncio.to_thread(pd.read_sas, path, format='xport', encoding="utf-8")
+
+async def clear_database(connection):
+    await connection.query("MATCH (n) CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS", db=ETLfunctions.db,
+                           consume="summary")
+
+async def run_benchmarks(data: str, neo4j: bool, latency: float, processes=()):
+    model = pipeline.engine.model
+    for name in model["datasets"]:
+        model["datasets"][name] = os.path.join(data, f"{name}.xpt")
+    target = ETLfunctions.conn if neo4j else None
+    recorder = RecordingConnection(target, latency)
+    ETLfunctions.conn = recorder
+    results = {}
+    # Reading stages decode the XPT files, the loaders then read them from the XPT cache when it is enabled
+    for name, path in model["datasets"].items():
+        rows = len(await read_dataset(path))
+        await measure(results, f"read {name}", recorder, read_dataset(path), rows=rows)
+        if pipeline.xpt_cache is not None:
+            await asyncio.to_thread(pipeline.xpt_cache.read, path)
+    if target is not None:
+        await clear_database(target)
+    # Each loader runs alone, in dependency order so relationships find their nodes in a real database
+    fused = pipeline.config.get("loading_mode", "two_pass") == "fused"
+    for job in pipeline.plan_jobs(list(model["nodes"]), list(model["relationships"]), fused):
+        await measure(results, f"loader {job['name']}", recorder,
+                      pipeline.build_subflow(f"Benchmark for {job['name']}", job["path"], job["loader"]))
+    if target is not None:
+        await clear_database(target)
+    await measure(results, "main_flow", recorder, pipeline.main_flow())
+    # Pipelined ingestion with each number of transform processes, to show how throughput scales with cores
+    if processes:
+        ingestion = pipeline.config.setdefault("ingestion", {})
+        settings = dict(ingestion)
+        ingestion["mode"] = "pipelined"
+        for count in processes:
+            ingestion["processes"] = count
+            pipeline.close_transform_pool()
+            # The workers are started before the stage, a deployment pays their start once per process
+            await asyncio.to_thread(lambda: list(pipeline.get_transform_pool().map(time.sleep, [0.5] * count)))
+            if target is not None:
+                await clear_database(target)
+            await measure(results, f"main_flow pipelined x{count}", recorder, pipeline.main_flow())
+        pipeline.close_transform_pool()
+        ingestion.clear()
+        ingestion.update(settings)
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float, min_seconds: float):
+    # A stage regresses when its throughput drops more than tolerance below the baseline.
+    # Stages shorter than min_seconds are dominated by flow overhead and are not compared
+    different = [stage for stage in results if stage.startswith("read ") and stage in baseline
+                 and results[stage]["rows"] != baseline[stage]["rows"]]
+    if different:
+        print(f"The baseline was measured on other datasets ({', '.join(different)}), throughput is not comparable")
+        return []
+    regressions = []
+    for stage, result in results.items():
+        previous = baseline.get(stage)
+        if previous is None or not previous["rows_per_sec"] or previous["seconds"] < min_seconds:
+            continue
+        change = result["rows_per_sec"] / previous["rows_per_sec"] - 1
+        if change < -tolerance:
+            regressions.append(stage)
+            print(f"REGRESSION {stage}: {result['rows_per_sec']} rows/sec against {previous['rows_per_sec']} ({change:+0.1%})")
+        else:
+            print(f"{stage}: {change:+0.1%} rows/sec against the baseline")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the ETL loaders on synthetic AdAM datasets")
+    parser.add_argument("--data", default="./benchmark_data", help="Directory written by SyntheticData.py")
+    parser.add_argument("--neo4j", action="store_true",
+                        help="Writes to the database of NEO4J_URI, which is cleared before the loaders and main_flow run")
+    parser.add_argument("--latency", type=float, default=0.001, help="Seconds per statement of the stand-in driver")
+    parser.add_argument("--processes", default="",
+                        help="Comma separated numbers of transform processes to run main_flow with in pipelined ingestion, e.g. 1,2,4,8")
+    parser.add_argument("--output", default="./benchmark_results.json")
+    parser.add_argument("--baseline", default="./benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Stores this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed throughput drop against the baseline")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Shortest baseline stage compared")
+    args = parser.parse_args()
+    processes = [int(count) for count in args.processes.split(",") if count]
+    results = asyncio.run(run_benchmarks(args.data, args.neo4j, args.latency, processes))
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline stored in {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance, args.min_seconds)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,153 @@
+import os
+import argparse
+import time
+import yaml
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from XPTcache import XptCache
+from GraphModel import project, endpoint_key_columns, key_ids, row_ids, apply_layout
+
+# Offline alternative to GraphETLpipeline.py for the first load of a large study. Writes
+# the nodes and relationships of the graph_model section of pipeline_config.yaml as the
+# header and data CSV files expected by neo4j-admin database import, without a database
+
+# Load YAML file with pipeline configuration, with the sections of its graph layout applied
+with open("pipeline_config.yaml", "r") as file:
+    config = apply_layout(yaml.safe_load(file))
+
+model = config["graph_model"]
+bulk_config = config.get("bulk_import", {})
+cache_config = config.get("xpt_cache", {})
+xpt_cache = XptCache(cache_config["directory"], cache_config["max_bytes"]) if cache_config.get("enabled") else None
+
+def read_dataset(name: str):
+    path = model["datasets"][name]
+    if not os.path.exists(path):
+        return None
+    if xpt_cache is not None:
+        return xpt_cache.read(path)
+    return pd.read_sas(path, format='xport', encoding="utf-8")
+
+def warm_cache(name: str):
+    # Decodes a dataset into the XPT cache so the export jobs memory-map it instead of decoding it again
+    if xpt_cache is not None:
+        read_dataset(name)
+
+def typed_columns(frame: pd.DataFrame):
+    # neo4j-admin header types, numeric properties are stored as double and the rest as strings
+    columns = []
+    for column in frame.columns:
+        if column.startswith(":") or not pd.api.types.is_numeric_dtype(frame[column]) or pd.api.types.is_bool_dtype(frame[column]):
+            columns.append(column)
+        else:
+            columns.append(f"{column}:double")
+    return columns
+
+def write_files(frame: pd.DataFrame, name: str, output: str, compress: bool):
+    header_file = f"{name}.header.csv"
+    data_file = f"{name}.csv.gz" if compress else f"{name}.csv"
+    with open(os.path.join(output, header_file), "w") as file:
+        file.write(",".join(typed_columns(frame)) + "\n")
+    frame.to_csv(os.path.join(output, data_file), header=False, index=False, compression="gzip" if compress else None)
+    return header_file, data_file
+
+def export_nodes(name: str, output: str, compress: bool):
+    node = model["nodes"][name]
+    id_column = f":ID({name})"
+    frames = []
+    for dataset in node["datasets"]:
+        df = read_dataset(dataset)
+        if df is None:
+            continue
+        frame = project(df, node["properties"])
+        for prop, value in node.get("constants", {}).items():
+            frame[prop] = value
+        if node.get("key"):
+            frame = frame.dropna(subset=node["key"])
+            frame.insert(0, id_column, key_ids(frame, node["key"]))
+        else:
+            frame.insert(0, id_column, row_ids(dataset, df))
+        frames.append(frame)
+    if not frames:
+        return None
+    frame = pd.concat(frames, ignore_index=True)
+    # Keyed nodes such as Visit appear in many rows and datasets but are written once
+    if node.get("key"):
+        frame = frame.drop_duplicates(subset=id_column, keep="last")
+    frame[":LABEL"] = ";".join(node["labels"])
+    return "nodes", write_files(frame, f"nodes_{name}", output, compress), len(frame)
+
+def endpoint_ids(endpoint: dict, df: pd.DataFrame, ids: pd.Series):
+    # ids are the row node identifiers of the unfiltered dataset, as written by export_nodes
+    if "match" in endpoint:
+        return key_ids(df, endpoint_key_columns(model, endpoint))
+    return ids.loc[df.index]
+
+def export_relationships(name: str, output: str, compress: bool):
+    relationship = model["relationships"][name]
+    start, end = relationship["start"], relationship["end"]
+    start_column, end_column = f":START_ID({start['node']})", f":END_ID({end['node']})"
+    frames = []
+    for dataset in relationship["datasets"]:
+        df = read_dataset(dataset)
+        if df is None:
+            continue
+        # Row node identifiers are positions in the whole dataset, so they are taken before any row is dropped
+        ids = row_ids(dataset, df)
+        # Rows with a null match key would not MATCH any node in the transactional loaders either
+        matched = [column for endpoint in (start, end) if "match" in endpoint
+                   for column in endpoint_key_columns(model, endpoint)]
+        missing = [column for column in matched if column not in df.columns]
+        if missing:
+            print(f"Dataset {dataset} has no {', '.join(missing)} column, its {name} relationships are skipped")
+            continue
+        df = df.dropna(subset=matched) if matched else df
+        frame = project(df, relationship.get("properties", {}))
+        frame.insert(0, start_column, endpoint_ids(start, df, ids))
+        frame.insert(1, end_column, endpoint_ids(end, df, ids))
+        frames.append(frame)
+    if not frames:
+        return None
+    frame = pd.concat(frames, ignore_index=True)
+    # Relationships between keyed nodes are merged in the graph, so only the last row of a pair is kept
+    if "match" in start and "match" in end:
+        frame = frame.drop_duplicates(subset=[start_column, end_column], keep="last")
+    frame[":TYPE"] = relationship["type"]
+    return "relationships", write_files(frame, f"relationships_{name}", output, compress), len(frame)
+
+def write_import_script(output: str, exports: list, database: str):
+    lines = ["#!/bin/sh",
+             "# Run with the target database stopped. Generated by BulkImportExport.py",
+             'cd "$(dirname "$0")"',
+             f"neo4j-admin database import full {database} --overwrite-destination --skip-bad-relationships \\"]
+    lines += [f"  --{kind}={header_file},{data_file} \\" for kind, (header_file, data_file), _ in exports]
+    lines[-1] = lines[-1].rstrip(" \\")
+    with open(os.path.join(output, "import.sh"), "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+def export_graph(output: str, compress: bool, workers: int, database: str):
+    os.makedirs(output, exist_ok=True)
+    for name, path in model["datasets"].items():
+        if not os.path.exists(path):
+            print(f"Dataset {name} not found in {path}, its nodes and relationships are skipped")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(warm_cache, model["datasets"]))
+        jobs = [pool.submit(export_nodes, name, output, compress) for name in model["nodes"]]
+        jobs += [pool.submit(export_relationships, name, output, compress) for name in model["relationships"]]
+        exports = [export for export in (job.result() for job in jobs) if export is not None]
+    for kind, (_, data_file), rows in exports:
+        print(f"Wrote {rows} {kind} to {data_file}")
+    write_import_script(output, exports, database)
+    return exports
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the graph model to neo4j-admin database import files")
+    parser.add_argument("--output", default=bulk_config.get("output_directory", "./import"))
+    parser.add_argument("--workers", type=int, default=bulk_config.get("workers", os.cpu_count()))
+    parser.add_argument("--database", default=bulk_config.get("database", "neo4j"))
+    parser.add_argument("--no-compress", action="store_true", help="Write plain CSV instead of gzip files")
+    args = parser.parse_args()
+    s = time.perf_counter()
+    export_graph(args.output, bulk_config.get("compress", True) and not args.no_compress, args.workers, args.database)
+    elapsed = time.perf_counter() - s
+    print(f"Export run in {elapsed:0.2f} seconds.")
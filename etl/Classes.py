@@ -1,32 +1,237 @@
-from neo4j import GraphDatabase
+import asyncio
+import sqlite3
+from neo4j import AsyncGraphDatabase
 
-class Neo4jConnection:
+class AsyncNeo4jConnection:
+    # Connection to Neo4j built on the driver's async API. Sessions are borrowed from the
+    # driver connection pool and the number of queries in flight is bounded so the
+    # gather-based fan-out of the pipeline cannot exhaust the pool or flood the server. Set max_in_flight to 1 to reproduce serial writes.
 
-    def __init__(self, uri, user, pwd):
+    def __init__(self, uri, user, pwd, max_connection_pool_size=50, connection_acquisition_timeout=60.0,
+                 max_in_flight=8, fetch_size=1000):
         self.__uri = uri
         self.__user = user
         self.__pwd = pwd
         self.__driver = None
+        self.__fetch_size = fetch_size
+        self.__in_flight = asyncio.Semaphore(max_in_flight)
         try:
-            self.__driver = GraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd))
-            print("Driver successfully created")
+            self.__driver = AsyncGraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd),
+                                                      max_connection_pool_size=max_connection_pool_size,
+                                                      connection_acquisition_timeout=connection_acquisition_timeout)
+            print("Async driver successfully created")
         except Exception as e:
-            print("Failed to create the driver:", e)
-        
-    def close(self):
+            print("Failed to create the async driver:", e)
+
+    async def close(self):
         if self.__driver is not None:
-            self.__driver.close()
-        
-    def query(self, query, parameters=None, db=None):
+            await self.__driver.close()
+
+    def __session(self, db):
+        if db is not None:
+            return self.__driver.session(database=db, fetch_size=self.__fetch_size)
+        return self.__driver.session(fetch_size=self.__fetch_size)
+
+    async def query(self, query, parameters=None, db=None, consume="records"):
+        # consume="records" returns the list of records, consume="summary" discards the
+        # records on the server side and only returns the ResultSummary, consume="both"
+        # returns the records together with the ResultSummary and consume="stream" returns
+        # an async generator of the records as they are fetched
+        if consume == "stream":
+            return self.stream(query, parameters, db)
         assert self.__driver is not None, "Driver not initialized!"
-        session = None
         response = None
-        try: 
-            session = self.__driver.session(database=db) if db is not None else self.__driver.session() 
-            response = list(session.run(query, parameters))
-        except Exception as e:
-            print("Query failed:", e)
-        finally: 
-            if session is not None:
-                session.close()
-        return response
\ No newline at end of file
+        async with self.__in_flight:
+            try:
+                async with self.__session(db) as session:
+                    result = await session.run(query, parameters)
+                    if consume == "summary":
+                        response = await result.consume()
+                    elif consume == "both":
+                        records = [record async for record in result]
+                        response = records, await result.consume()
+                    else:
+                        response = [record async for record in result]
+            except Exception as e:
+                print("Query failed:", e)
+        return response
+
+    async def stream(self, query, parameters=None, db=None):
+        # Yields records as they are fetched in batches of fetch_size instead of
+        # materialising the whole result. The session and the in flight slot are held
+        # until the records are exhausted or the generator is closed
+        assert self.__driver is not None, "Driver not initialized!"
+        async with self.__in_flight:
+            async with self.__session(db) as session:
+                result = await session.run(query, parameters)
+                async for record in result:
+                    yield record
+
+
+class AdaptiveBatchController:
+    # Tunes the batch size and the number of concurrent write transactions of one dataset
+    # from the observed commit latency, throughput and lock errors (additive increase,
+    # multiplicative decrease). Batches grow while commits stay under target_latency,
+    # concurrency is raised while it improves throughput and both are halved on lock or
+    # deadlock errors.
+
+    def __init__(self, batch_size=1000, min_batch_size=100, max_batch_size=20000,
+                 concurrency=2, max_concurrency=8, target_latency=2.0, window=4):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.__min_batch_size = min_batch_size
+        self.__max_batch_size = max_batch_size
+        self.__max_concurrency = max_concurrency
+        self.__target_latency = target_latency
+        self.__window = window
+        self.__window_rows = 0
+        self.__window_batches = 0
+        self.__window_start = None
+        self.__last_throughput = 0.0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def start(self, now):
+        if self.__window_start is None:
+            self.__window_start = now
+
+    def record(self, rows, latency, errors, now):
+        self.rows += rows
+        self.batches += 1
+        self.errors += errors
+        if errors:
+            self.batch_size = max(self.__min_batch_size, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+            self.__reset_window(now)
+            return
+        if latency > 2 * self.__target_latency:
+            self.batch_size = max(self.__min_batch_size, int(self.batch_size * 0.7))
+            self.concurrency = max(1, self.concurrency - 1)
+        elif latency > self.__target_latency:
+            self.batch_size = max(self.__min_batch_size, int(self.batch_size * 0.7))
+        else:
+            self.batch_size = min(self.__max_batch_size, int(self.batch_size * 1.25))
+        # Concurrency is only raised when the last window was faster than the one before it
+        self.__window_rows += rows
+        self.__window_batches += 1
+        if self.__window_batches >= self.__window:
+            throughput = self.__window_rows / max(now - self.__window_start, 1e-9)
+            if throughput >= self.__last_throughput * 1.05:
+                self.concurrency = min(self.__max_concurrency, self.concurrency + 1)
+            elif throughput < self.__last_throughput * 0.9:
+                self.concurrency = max(1, self.concurrency - 1)
+            self.__last_throughput = throughput
+            self.__reset_window(now)
+
+    def __reset_window(self, now):
+        self.__window_rows = 0
+        self.__window_batches = 0
+        self.__window_start = now
+
+    def summary(self):
+        return {"batch_size": self.batch_size, "concurrency": self.concurrency, "rows": self.rows,
+                "batches": self.batches, "errors": self.errors,
+                "rows_per_sec": round(self.rows / max(self.elapsed, 1e-9), 1)}
+
+
+class DatasetMetrics:
+    # Read, transform and write measurements of one loader on one dataset. Server side
+    # counters and times come from the ResultSummary of each batch and the committed
+    # inner transactions from the REPORT STATUS rows returned by the loaders
+
+    def __init__(self, loader, path):
+        self.loader = loader
+        self.path = path
+        self.rows_read = 0
+        self.read_seconds = 0.0
+        self.batches = []
+
+    def record_read(self, rows, seconds):
+        self.rows_read += rows
+        self.read_seconds += seconds
+
+    def record_batch(self, rows, transform_seconds, payload_bytes, client_seconds, records, summary):
+        batch = {"loader": self.loader, "path": self.path, "batch": len(self.batches), "rows": rows,
+                 "transform_seconds": round(transform_seconds, 4), "payload_bytes": payload_bytes,
+                 "client_seconds": round(client_seconds, 4), "db_seconds": None, "nodes_created": 0,
+                 "relationships_created": 0, "properties_set": 0, "transactions_committed": 0,
+                 "transactions_failed": 0, "failed": records is None}
+        if summary is not None:
+            # Time until the first record was available plus the time to stream all of them
+            batch["db_seconds"] = ((summary.result_available_after or 0) + (summary.result_consumed_after or 0)) / 1000
+            batch["nodes_created"] = summary.counters.nodes_created
+            batch["relationships_created"] = summary.counters.relationships_created
+            batch["properties_set"] = summary.counters.properties_set
+        for record in records or []:
+            if record.get("committed"):
+                batch["transactions_committed"] += 1
+            else:
+                batch["transactions_failed"] += 1
+        self.batches.append(batch)
+        return batch
+
+    def totals(self):
+        totals = {"loader": self.loader, "path": self.path, "rows_read": self.rows_read,
+                  "read_seconds": round(self.read_seconds, 4), "batches": len(self.batches),
+                  "failed_batches": sum(batch["failed"] for batch in self.batches)}
+        for key in ("rows", "transform_seconds", "payload_bytes", "client_seconds", "db_seconds", "nodes_created",
+                    "relationships_created", "properties_set", "transactions_committed", "transactions_failed"):
+            totals[key] = round(sum(batch[key] or 0 for batch in self.batches), 4)
+        return totals
+
+
+class LoadMetrics:
+    # Collects the DatasetMetrics of a pipeline run
+
+    def __init__(self):
+        self.datasets = []
+
+    def reset(self):
+        self.datasets = []
+
+    def dataset(self, loader, path):
+        metrics = DatasetMetrics(loader, path)
+        self.datasets.append(metrics)
+        return metrics
+
+    def report(self):
+        return {"datasets": [metrics.totals() for metrics in self.datasets],
+                "batches": [batch for metrics in self.datasets for batch in metrics.batches]}
+
+
+class RowStateStore:
+    # Local SQLite store with the content hash of every row written by an incremental
+    # loader, keyed by the loader (scope) and the hash of the row natural key
+
+    def __init__(self, path):
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS row_state ("
+            "scope TEXT NOT NULL, row_key TEXT NOT NULL, row_hash TEXT NOT NULL, "
+            "PRIMARY KEY (scope, row_key))")
+        self.__connection.commit()
+
+    def close(self):
+        self.__connection.close()
+
+    def diff(self, scope, row_keys, row_hashes):
+        # Returns a mask of the new or changed rows, the keys of the changed rows and the keys
+        # of the rows that were written before but are no longer present
+        previous = dict(self.__connection.execute(
+            "SELECT row_key, row_hash FROM row_state WHERE scope = ?", (scope,)))
+        changed_mask = [previous.get(key) != row_hash for key, row_hash in zip(row_keys, row_hashes)]
+        changed_keys = [key for key, row_hash in zip(row_keys, row_hashes)
+                        if key in previous and previous[key] != row_hash]
+        retracted_keys = list(previous.keys() - set(row_keys))
+        return changed_mask, changed_keys, retracted_keys
+
+    def commit(self, scope, row_keys, row_hashes, retracted_keys):
+        with self.__connection:
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO row_state (scope, row_key, row_hash) VALUES (?, ?, ?)",
+                [(scope, key, row_hash) for key, row_hash in zip(row_keys, row_hashes)])
+            self.__connection.executemany(
+                "DELETE FROM row_state WHERE scope = ? AND row_key = ?",
+                [(scope, key) for key in retracted_keys])
@@ -1,334 +1,208 @@
 import pandas as pd
-from Classes import Neo4jConnection
+import time
+from Classes import AsyncNeo4jConnection, DatasetMetrics
+from GraphModel import CompiledQuery, payload_bytes as measure_payload
 import logging
 from dotenv import dotenv_values
 import os
+import yaml
 
-# create connection object using neo4j
+# Load YAML file with the connection pool settings
+with open("pipeline_config.yaml", "r") as file:
+    pipeline_config = yaml.safe_load(file)
+connection_config = pipeline_config.get("connection", {})
+# Payload sizes are estimated from a sample of each batch unless exact_payload_bytes is set
+exact_payload_bytes = pipeline_config.get("metrics", {}).get("exact_payload_bytes", False)
+
+# create asynchronous connection object using neo4j
 data = dotenv_values(".env")
-conn = Neo4jConnection(uri=os.getenv("NEO4J_URI"), 
-                       user=os.getenv("NEO4J_USER"),              
-                       pwd= os.getenv("NEO4J_PASSWORD"))
+conn = AsyncNeo4jConnection(uri=os.getenv("NEO4J_URI"), 
+                            user=os.getenv("NEO4J_USER"),              
+                            pwd= os.getenv("NEO4J_PASSWORD"),
+                            **connection_config)
 
 db="neo4j"
 
-# Create graph nodes
-
-async def create_patients_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    # Adds patient nodes to the Neo4j graph.
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    CREATE (p:Patient {USUBJID: row.USUBJID, AGE: row.AGE, ARM:row.ARM, SEX: row.SEX, BMI: row.BMIBL})
-    RETURN p
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
-    '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
-    
-async def create_chemlab_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    # Adds chemical laboratory measurements nodes to the Neo4j graph.
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    CREATE (pa:Parameter:Chemistry {USUBJID: row.USUBJID, VISIT: row.VISIT, Laboratory: row.PARCAT1, Parameter: row.PARAM, Value: row.AVAL, Reference: row.LBNRIND, Dataset: 'adlbc'})
-    RETURN pa
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN pa.USUBJID, s.started, s.committed, s.errorMessage
-    '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
+# Create graph nodes and relationships from the Cypher compiled by the mapping engine
+
+def build_loader(compiled: CompiledQuery):
+    # Wraps a compiled query into a loader with the same signature as the pipeline functions.
+    # Given the DatasetMetrics of the dataset being loaded it also records the batch measurements.
+    # loader.write sends a payload already prepared by the transform pool
+    async def write(data: list, transform_seconds: float, logger:  logging.Logger, metrics: DatasetMetrics = None,
+                    payload_bytes: int = None):
+        parameters = {'rows': data, 'constants': compiled.constants}
+        try:
+            if metrics is None:
+                return await conn.query(compiled.query, parameters = parameters, db=db)
+            if payload_bytes is None:
+                payload_bytes = measure_payload(data, exact_payload_bytes)
+            start = time.perf_counter()
+            response = await conn.query(compiled.query, parameters = parameters, db=db, consume="both")
+            records, summary = response if response is not None else (None, None)
+            batch = metrics.record_batch(len(data), transform_seconds, payload_bytes, time.perf_counter() - start,
+                                         records, summary)
+            # ON ERROR CONTINUE rolls back the failed inner transactions without raising
+            if batch["transactions_failed"]:
+                errors = {record.get("errorMessage") for record in records if not record.get("committed")}
+                logger.warning(f"{compiled.name}: {batch['transactions_failed']} inner transactions of batch "
+                               f"{batch['batch']} failed: {'; '.join(str(error) for error in errors)}")
+            return records
+        except Exception as e:
             logger.error(f"Error sending the data: {e}")
 
-async def create_hemolab_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    # Adds hematology laboratory measurements nodes to the Neo4j graph.
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    CREATE (pa:Parameter:Hematology {USUBJID: row.USUBJID, VISIT: row.VISIT, Laboratory: row.PARCAT1, Parameter: row.PARAM, Value: row.AVAL, Reference: row.LBNRIND, Dataset: 'adlbh'})
-    RETURN pa
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN pa.USUBJID, s.started, s.committed, s.errorMessage
+    async def loader(df: pd.DataFrame, logger:  logging.Logger, metrics: DatasetMetrics = None):
+        start = time.perf_counter()
+        data = compiled.payload(df)
+        return await write(data, time.perf_counter() - start, logger, metrics)
+    loader.__name__ = compiled.name
+    loader.compiled = compiled
+    loader.write = write
+    return loader
+
+
+# Delete nodes replaced or retracted since the last incremental load
+
+async def delete_nodes_by_rowkey(label: str, keys: list, logger:  logging.Logger):
+    query = f'''
+    UNWIND $keys AS key
+    CALL {{
+    WITH key
+    MATCH (n:{label} {{RowKey: key}})
+    DETACH DELETE n
+    }} IN TRANSACTIONS OF 10000 ROWS
     '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
+    try:
+        return await conn.query(query, parameters = {'keys': keys}, db=db, consume="summary")
     except Exception as e:
-            logger.error(f"Error sending the data: {e}")
+            logger.error(f"Error deleting the data: {e}")
 
-async def create_vitalsigns_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    # Adds vital signs measurements nodes to the Neo4j graph.
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    CREATE (vs:Parameter:VitalSign {USUBJID: row.USUBJID, VISIT: row.VISIT, Laboratory: 'VS', Parameter: row.PARAM, Value: row.AVAL, Reference: '', Dataset: 'advs'})
-    RETURN vs
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN vs.USUBJID, s.started, s.committed, s.errorMessage
-    '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
 
-async def create_adadas_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    # Adds ADADAS endpoint nodes
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    CREATE (ep:Endpoint:ADAS {USUBJID: row.USUBJID, VISIT: row.VISIT, EndpointName: 'ADAS-Cog', Parameter: row.PARAM, Value: row.AVAL, Reference: '', Dataset: 'adadas'})
-    RETURN ep
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN ep.USUBJID, s.started, s.committed, s.errorMessage
-    '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
+# Create graph schema
 
-async def create_cibc_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    # Adds ADADAS endpoint nodes
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    CREATE (ep:Endpoint:CIBC {USUBJID: row.USUBJID, VISIT: row.VISIT, EndpointName: 'CIBC Score', Parameter: row.PARAM, Value: row.AVAL, Reference: '', Dataset: 'adcibc'})
-    RETURN ep
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN ep.USUBJID, s.started, s.committed, s.errorMessage
-    '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
+def property_list(variable: str, properties: list):
+    # Formats the properties of a constraint or index as n.A or (n.A, n.B)
+    items = ", ".join(f"{variable}.{prop}" for prop in properties)
+    return items if len(properties) == 1 else f"({items})"
 
-async def create_treatment_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    treatment_set = set(df['ARM'])
-    treatment_list = list(treatment_set)
-    try: 
-        query = '''
-        UNWIND $list AS item
-        MERGE (t:Treatment {Name: item})
-        '''
-        return conn.query(query, parameters= {'list': treatment_list}, db=db)
+async def create_constraint(constraint: dict, logger:  logging.Logger):
+    query = f'''
+    CREATE CONSTRAINT {constraint["name"]} IF NOT EXISTS
+    FOR (n:{constraint["label"]})
+    REQUIRE {property_list("n", constraint["properties"])} IS UNIQUE
+    '''
+    try:
+        return await conn.query(query, db=db, consume="summary")
     except Exception as e:
-            logger.error(f"Error sending the data: {e}")
-        
+        logger.error(f"Error creating constraint {constraint['name']}: {e}")
 
-async def create_adverseevent_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    adversevent_set = set(df['AETERM'])
-    adversevent_list = list(adversevent_set)
-    try: 
-        query = '''
-        UNWIND $list AS item
-        MERGE (ae:AdverseEvent {Term: item})
-        '''
-        return conn.query(query, parameters={'list': adversevent_list}, db=db)
+async def create_index(index: dict, logger:  logging.Logger):
+    # Range indexes by default, text indexes with type text serve CONTAINS and ENDS WITH filters
+    kind = "TEXT INDEX" if index.get("type") == "text" else "INDEX"
+    query = f'''
+    CREATE {kind} {index["name"]} IF NOT EXISTS
+    FOR (n:{index["label"]})
+    ON ({", ".join(f"n.{prop}" for prop in index["properties"])})
+    '''
+    try:
+        return await conn.query(query, db=db, consume="summary")
     except Exception as e:
-            logger.error(f"Error sending the data: {e}")
+        logger.error(f"Error creating index {index['name']}: {e}")
 
-async def create_visit_nodes(df: pd.DataFrame, logger:  logging.Logger):
-    visit_set = set(df['VISIT'])
-    visit_list = list(visit_set)
+async def await_indexes(timeout: int, logger:  logging.Logger):
+    # Blocks until every index is ONLINE and returns the ones that are still populating or failed
     try:
+        await conn.query("CALL db.awaitIndexes($timeout)", parameters={'timeout': timeout}, db=db, consume="summary")
         query = '''
-        UNWIND $list AS item
-        MERGE (v:Visit {Name: item})
-            '''
-        return conn.query(query, parameters = {'list': visit_list}, db=db)
+        SHOW INDEXES YIELD name, state, populationPercent
+        WHERE state <> 'ONLINE'
+        RETURN name, state, populationPercent
+        '''
+        return await conn.query(query, db=db)
     except Exception as e:
-        logger.error(f"Error sending the data: {e}")
+        logger.error(f"Error waiting for indexes: {e}")
 
 
-# Create relationships
+# Stamp the graph after a load so the QA service refreshes its schema
 
-async def create_patient_treatment_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
+async def bump_graph_version(logger:  logging.Logger):
     query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (t:Treatment {Name:row.ARM}) 
-    MERGE (p)-[r:WAS_TREATED]->(t)
-    SET r.Dose=row.TRT01PN
-    RETURN p, r
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
+    MERGE (v:GraphVersion {Name: 'AdAMGraph'})
+    SET v.version = coalesce(v.version, 0) + 1, v.loadedAt = datetime()
+    RETURN v.version AS version
     '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
+    try:
+        records = await conn.query(query, db=db)
+        return records[0]["version"] if records else None
     except Exception as e:
-            logger.error(f"Error sending the data: {e}")
+        logger.error(f"Error updating the graph version: {e}")
 
-async def create_patient_adverseevent_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (ae:AdverseEvent {Term: row.AETERM}) 
-    MERGE (p)-[r:EXPERIENCED_ADVERSE_EVENT]->(ae)
-    SET r={Severity: row.AESEV, Type: row.AEBODSYS}
-    RETURN p, r
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
-    '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
 
-async def create_patient_visit_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    unique_df = df.drop_duplicates(subset=['USUBJID', 'VISIT'])
-    data = unique_df.to_dict(orient='records')
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (v:Visit {Name: row.VISIT}) 
-    MERGE (p)-[r:ATTENDED_VISIT]->(v)
-    RETURN p, r
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
-    '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
+# Summary projections rebuilt after every load. Each projection is a list of statements run in order,
+# the first ones removing the projection of the previous load. The parameter of a measurement is
+# read from its ParameterDefinition in the compact graph layout
 
-async def create_patient_chemistrylab_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (param:Parameter:Chemistry {USUBJID: row.USUBJID, VISIT: row.VISIT, Laboratory: row.PARCAT1,Parameter: row.PARAM, Value: row.AVAL, Reference: row.LBNRIND, Dataset: 'adlbc'}), (v:Visit {Name: row.VISIT})
-    CREATE (p)-[lb:MEASURED_LABPARAMETER]->(param)
-    CREATE (param)<-[:MEASURED_IN_VISIT]-(v)
-    SET lb={ChangeFromBaseline: row.CHG}
-    RETURN p, lb
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
-        '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
+MEASUREMENT_EDGES = "MEASURED_LABPARAMETER|MEASURED_VITALSIGN|ASSESSED_ENDPOINT"
 
-async def create_patient_hemolab_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (param:Parameter:Hematology {USUBJID: row.USUBJID,VISIT: row.VISIT, Laboratory: row.PARCAT1,Parameter: row.PARAM, Value: row.AVAL, Reference: row.LBNRIND, Dataset: 'adlbh'}), (v:Visit {Name: row.VISIT})
-    CREATE (p)-[lb:MEASURED_LABPARAMETER]->(param)
-    CREATE (param)<-[:MEASURED_IN_VISIT]-(v)
-    SET lb={ChangeFromBaseline: row.CHG}
-    RETURN p, lb
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
+PROJECTIONS = {
+    "parameter_summary": [
         '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
-
-async def create_patient_vitalsign_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (param:Parameter:VitalSign {USUBJID: row.USUBJID, VISIT: row.VISIT, Laboratory: 'VS' ,Parameter: row.PARAM, Value: row.AVAL}), (v:Visit {Name: row.VISIT})
-    CREATE (p)-[vs:MEASURED_VITALSIGN]->(param)
-    CREATE (param)<-[:MEASURED_IN_VISIT]-(v)
-    SET vs={ChangeFromBaseline: row.CHG}
-    RETURN p, vs
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
+        MATCH (s:ParameterSummary)
+        CALL { WITH s DETACH DELETE s } IN TRANSACTIONS OF 10000 ROWS
+        ''',
+        f'''
+        MATCH (t:Treatment)<-[:WAS_TREATED]-(p:Patient)-[:{MEASUREMENT_EDGES}]->(m)<-[:MEASURED_IN_VISIT]-(v:Visit)
+        WHERE m.Value IS NOT NULL AND NOT isNaN(m.Value)
+        OPTIONAL MATCH (m)-[:OF_PARAMETER]->(d:ParameterDefinition)
+        WITH t.Name AS treatment, v.Name AS visit, coalesce(d.Parameter, m.Parameter) AS parameter,
+             coalesce(d.Dataset, m.Dataset) AS dataset,
+             count(m) AS measurements, count(DISTINCT p) AS patients, avg(m.Value) AS mean,
+             min(m.Value) AS minimum, max(m.Value) AS maximum, stDev(m.Value) AS deviation
+        CREATE (:ParameterSummary {{Treatment: treatment, Visit: visit, Parameter: parameter, Dataset: dataset,
+                Count: measurements, Patients: patients, Mean: mean, Min: minimum, Max: maximum, StdDev: deviation}})
+        ''',
+    ],
+    "latest_measurement": [
         '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
-
-async def create_patient_adadas_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (end:Endpoint:ADAS {USUBJID: row.USUBJID, VISIT: row.VISIT, EndpointName: 'ADAS-Cog', Parameter: row.PARAM, Value: row.AVAL, Reference: '', Dataset: 'adadas'}), (v:Visit {Name: row.VISIT})
-    CREATE (p)-[endrel:ASSESSED_ENDPOINT]->(end)
-    CREATE (end)<-[:MEASURED_IN_VISIT]-(v)
-    SET endrel={ChangeFromBaseline: row.CHG}
-    RETURN p, endrel
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
+        MATCH ()-[r:LATEST_MEASUREMENT]->()
+        CALL { WITH r DELETE r } IN TRANSACTIONS OF 10000 ROWS
+        ''',
+        f'''
+        MATCH (p:Patient)
+        CALL {{
+        WITH p
+        MATCH (p)-[:{MEASUREMENT_EDGES}]->(m)
+        WHERE m.Date IS NOT NULL AND NOT isNaN(m.Date)
+        OPTIONAL MATCH (m)-[:OF_PARAMETER]->(d:ParameterDefinition)
+        WITH p, m, coalesce(d.Parameter, m.Parameter) AS parameter ORDER BY m.Date DESC
+        WITH p, parameter, collect(m)[0] AS latest
+        CREATE (p)-[:LATEST_MEASUREMENT]->(latest)
+        }} IN TRANSACTIONS OF 100 ROWS
+        ''',
+    ],
+    # The EXPERIENCED_ADVERSE_EVENT relationships are merged to one per patient and term with
+    # the severity of its last row, so they count patient and term pairs, not occurrences
+    "adverse_event_summary": [
         '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
-    except Exception as e:
-            logger.error(f"Error sending the data: {e}")
-
-async def create_patient_cibc_relationship(df: pd.DataFrame, logger:  logging.Logger):
-    data = df.to_dict(orient='records')
-    query = '''
-    UNWIND $rows AS row
-    CALL {
-    WITH row
-    MATCH (p:Patient {USUBJID: row.USUBJID}), (end:Endpoint:CIBC {USUBJID: row.USUBJID, VISIT: row.VISIT, EndpointName: 'CIBC Score', Parameter: row.PARAM, Value: row.AVAL, Reference: '', Dataset: 'adcibc'}), (v:Visit {Name: row.VISIT})
-    CREATE (p)-[endrel:ASSESSED_ENDPOINT]->(end)
-    CREATE (end)<-[:MEASURED_IN_VISIT]-(v)
-    SET endrel={ChangeFromBaseline: row.CHG}
-    RETURN p, endrel
-    } IN TRANSACTIONS OF 10000 ROWS
-    ON ERROR CONTINUE
-    REPORT STATUS AS s
-    RETURN p.USUBJID, s.started, s.committed, s.errorMessage
+        MATCH (s:AdverseEventSummary)
+        DETACH DELETE s
+        ''',
         '''
-    try: 
-        return conn.query(query, parameters = {'rows': data}, db=db)
+        MATCH (t:Treatment)<-[:WAS_TREATED]-(p:Patient)-[e:EXPERIENCED_ADVERSE_EVENT]->(:AdverseEvent)
+        WITH t.Name AS treatment, e.Type AS bodySystem, count(e) AS terms, count(DISTINCT p) AS patients,
+             sum(CASE WHEN e.Severity = 'SEVERE' THEN 1 ELSE 0 END) AS severe
+        CREATE (:AdverseEventSummary {Treatment: treatment, BodySystem: bodySystem, Patients: patients,
+                PatientTerms: terms, PatientTermsLastSevere: severe})
+        ''',
+    ],
+}
+
+async def build_projection(name: str, logger:  logging.Logger):
+    # Returns the ResultSummary of each statement of the projection
+    summaries = []
+    try:
+        for query in PROJECTIONS[name]:
+            summaries.append(await conn.query(query, db=db, consume="summary"))
+        return summaries
     except Exception as e:
-            logger.error(f"Error sending the data: {e}")
\ No newline at end of file
+        logger.error(f"Error building projection {name}: {e}")
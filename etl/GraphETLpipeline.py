@@ -1,64 +1,101 @@
 import pandas as pd
 import sqlalchemy as sa
 import asyncio
+import time
+import json
+import os
 from prefect import task, flow, get_run_logger, serve
+from prefect.artifacts import create_table_artifact
 import yaml
 
-# Load YAML file with pipeline configuration
+# Load YAML file with pipeline configuration, with the sections of its graph layout applied
+from GraphModel import apply_layout
 with open("pipeline_config.yaml", "r") as file:
-    config = yaml.safe_load(file)
-
-# Import ETL Functions to create nodes from the SQL queries
-from ETLfunctions import (
-                              create_patients_nodes,
-                                create_chemlab_nodes,
-                                create_hemolab_nodes,
-                                create_vitalsigns_nodes,
-                                create_adadas_nodes,
-                                create_cibc_nodes,
-                                create_treatment_nodes,
-                                create_adverseevent_nodes,
-                                create_visit_nodes)
-
-# Import ETL Functions to create edges from the SQL queries
-
-from ETLfunctions import (
-create_patient_treatment_relationship,
-create_patient_adverseevent_relationship,
-create_patient_chemistrylab_relationship,
-create_patient_hemolab_relationship,
-create_patient_vitalsign_relationship,
-create_patient_adadas_relationship,
-create_patient_cibc_relationship,
-create_patient_visit_relationship)
-
-# Parses function names referenced in the pipeline_configuration.yaml file into actual python function objects imported
-
-function_parser = {
-"create_patients_nodes": create_patients_nodes,
-"create_chemlab_nodes":create_chemlab_nodes,
-"create_hemolab_nodes":create_hemolab_nodes,
-"create_vitalsigns_nodes":create_vitalsigns_nodes,
-"create_adadas_nodes":create_adadas_nodes,
-"create_cibc_nodes":create_cibc_nodes,
-"create_treatment_nodes":create_treatment_nodes,
-"create_adverseevent_nodes": create_adverseevent_nodes,
-"create_visit_nodes": create_visit_nodes,
-"create_patient_treatment_relationship":create_patient_treatment_relationship,
-"create_patient_adverseevent_relationship":create_patient_adverseevent_relationship,
-"create_patient_chemistrylab_relationship":create_patient_chemistrylab_relationship,
-"create_patient_hemolab_relationship": create_patient_hemolab_relationship,
-"create_patient_vitalsign_relationship":create_patient_vitalsign_relationship,
-"create_patient_adadas_relationship":create_patient_adadas_relationship,
-"create_patient_cibc_relationship":create_patient_cibc_relationship,
-"create_patient_visit_relationship": create_patient_visit_relationship
-}
+    config = apply_layout(yaml.safe_load(file))
+
+# Decoded XPT files are cached as memory-mappable Arrow files shared by all subflows
+from XPTcache import XptCache
+cache_config = config.get("xpt_cache", {})
+xpt_cache = XptCache(cache_config["directory"], cache_config["max_bytes"]) if cache_config.get("enabled") else None
+
+# In pipelined ingestion a pool of processes decodes and transforms the batches that the event loop writes.
+# Workers are spawned rather than forked, a fork would copy the locks held by the threads of Prefect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import TransformWorkers
+transform_pool = None
+
+def transform_processes():
+    return config.get("ingestion", {}).get("processes") or os.cpu_count()
+
+def get_transform_pool():
+    global transform_pool
+    if transform_pool is None:
+        transform_pool = ProcessPoolExecutor(max_workers=transform_processes(), mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=TransformWorkers.init_worker,
+                                             initargs=(cache_config["directory"], cache_config["max_bytes"]))
+    return transform_pool
+
+def close_transform_pool():
+    global transform_pool
+    if transform_pool is not None:
+        transform_pool.shutdown()
+        transform_pool = None
+
+# Tunes batch size and write concurrency per dataset from observed commit latency
+from Classes import AdaptiveBatchController
+
+# Incremental loads only write rows whose content changed since the state stored in a local SQLite file
+from Classes import RowStateStore
+incremental_config = config.get("incremental", {})
+state_store = RowStateStore(incremental_config["state_store"]) if incremental_config.get("enabled") else None
+
+# Read, transform and write measurements per loader, dataset and batch of a run
+from Classes import LoadMetrics
+metrics_config = config.get("metrics", {})
+load_metrics = LoadMetrics() if metrics_config.get("enabled") else None
+
+# The mapping engine compiles the loaders of the graph_model section into Cypher once
+from GraphModel import MappingEngine
+engine = MappingEngine(config["graph_model"], row_key_nodes=incremental_config.get("nodes", {}) if state_store is not None else ())
+
+# Import ETL Function to turn compiled queries into graph writing functions
+
+from ETLfunctions import build_loader
+
+# Import ETL Functions to create the graph schema
+
+from ETLfunctions import create_constraint, create_index, await_indexes
+
+# Import ETL Functions to delete replaced or retracted rows in incremental loads
+
+from ETLfunctions import delete_nodes_by_rowkey
+
+# Import ETL Function to stamp the graph version read by the QA service
+
+from ETLfunctions import bump_graph_version
+
+# Import ETL Function to build the summary projections after a load
+
+from ETLfunctions import build_projection
 
 @task(name="read-sas-file", description="Passes sql state ment to run a query")
 async def read_data(path: str):
+    if xpt_cache is not None:
+        return await asyncio.to_thread(xpt_cache.read, path)
     df = pd.read_sas(path,format='xport', encoding="utf-8")
     return df
 
+def stream_data(path: str, chunk_rows: int):
+    # Generator of row chunks that never holds the whole file in memory. Files already in
+    # the XPT cache are streamed from their memory-mapped Arrow batches
+    if xpt_cache is not None and xpt_cache.contains(path):
+        yield from xpt_cache.batches(path, chunk_rows)
+    else:
+        with pd.read_sas(path, format='xport', encoding="utf-8", chunksize=chunk_rows) as reader:
+            for chunk in reader:
+                yield chunk
+
 @task(name="split-dataframe", description="Splits large dataframes into chunks")
 async def split_dataframe(df:pd.DataFrame, max_chunk_size:int):
     num_rows = len(df)
@@ -73,55 +110,407 @@ async def split_dataframe(df:pd.DataFrame, max_chunk_size:int):
         chunks[-1] = pd.concat([chunks[-1], last_chunk])
     return chunks
 
+def batch_committed(response):
+    # Loaders return the REPORT STATUS rows of CALL IN TRANSACTIONS or None when the query failed.
+    # Rows of a batch are only known to be written when every inner transaction committed
+    return response is not None and all(record.get("committed") for record in response)
+
+def committed_row_keys(chunk: pd.DataFrame, response):
+    if "RowKey" not in chunk.columns or not batch_committed(response):
+        return []
+    return chunk["RowKey"].tolist()
+
 @task(name="wirte-graph", description="Executes a writing operation on the graph")
-async def write_graph(function, split_results: pd.DataFrame, logger):
+async def write_graph(function, split_results: pd.DataFrame, logger, metrics=None):
+    # Returns the row keys of the batches that committed
     process_chunks = []
     for chunk in split_results:
-        write_task = function(chunk, logger)
+        write_task = function(chunk, logger, metrics)
         process_chunks.append(write_task)
-    await asyncio.gather(*process_chunks)
+    responses = await asyncio.gather(*process_chunks)
+    return [key for chunk, response in zip(split_results, responses) for key in committed_row_keys(chunk, response)]
 
+def is_incremental(function):
+    return state_store is not None and function.__name__ in incremental_config.get("nodes", {})
+
+def add_row_keys(df: pd.DataFrame, keys: list):
+    # RowKey hashes the natural key plus the occurrence number of the key, which tells apart
+    # rows sharing a natural key. RowHash hashes the content of the whole row
+    df = df.copy()
+    natural_key = df[keys].copy()
+    natural_key["occurrence"] = df.groupby(keys, dropna=False).cumcount()
+    row_hashes = pd.util.hash_pandas_object(df, index=False)
+    df["RowKey"] = pd.util.hash_pandas_object(natural_key, index=False).map("{:016x}".format)
+    df["RowHash"] = row_hashes.map("{:016x}".format)
+    return df
+
+@task(name="diff-against-state", description="Keeps the new or changed rows and deletes the stale ones from the graph")
+async def diff_against_state(function, df: pd.DataFrame, logger):
+    scope = function.__name__
+    settings = incremental_config["nodes"][scope]
+    df = add_row_keys(df, settings["keys"])
+    changed_mask, changed_keys, retracted_keys = state_store.diff(scope, df["RowKey"], df["RowHash"])
+    # Changed rows of loaders without a unique natural key in the graph are deleted and written again
+    stale_keys = retracted_keys + (changed_keys if settings.get("strategy", "replace") == "replace" else [])
+    if stale_keys:
+        await delete_nodes_by_rowkey(engine.model["nodes"][scope]["labels"][-1], stale_keys, logger)
+    changed = df[changed_mask]
+    logger.info(f"{scope}: {len(changed) - len(changed_keys)} new, {len(changed_keys)} changed, "
+                f"{len(retracted_keys)} retracted and {len(df) - len(changed)} unchanged rows")
+    return changed, retracted_keys
+
+def lock_errors(response):
+    # Loaders return the REPORT STATUS rows of CALL IN TRANSACTIONS or None when the query failed
+    if response is None:
+        return 1
+    return sum(1 for record in response if "lock" in str(record.get("errorMessage") or "").lower())
+
+@task(name="write-graph-adaptive", description="Writes a dataframe in batches sized from the observed commit latency")
+async def write_graph_adaptive(function, df: pd.DataFrame, controller: AdaptiveBatchController, logger, metrics=None):
+    # Returns the controller settings and the row keys of the batches that committed
+    committed = []
+
+    async def write_batch(chunk):
+        batch_start = time.perf_counter()
+        response = await function(chunk, logger, metrics)
+        committed.extend(committed_row_keys(chunk, response))
+        return len(chunk), time.perf_counter() - batch_start, lock_errors(response)
+
+    position = 0
+    in_flight = set()
+    start = time.perf_counter()
+    controller.start(start)
+    while position < len(df) or in_flight:
+        # Keep as many batches in flight as the controller currently allows
+        while position < len(df) and len(in_flight) < controller.concurrency:
+            chunk = df.iloc[position: position + controller.batch_size]
+            position += len(chunk)
+            in_flight.add(asyncio.ensure_future(write_batch(chunk)))
+        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for finished in done:
+            rows, latency, errors = finished.result()
+            controller.record(rows, latency, errors, time.perf_counter())
+    controller.elapsed = time.perf_counter() - start
+    return controller.summary(), committed
 
 @flow
 async def subflow(path: str, function):
     logger = get_run_logger()
+    metrics = load_metrics.dataset(function.__name__, path) if load_metrics is not None else None
+    read_start = time.perf_counter()
     result = await read_data(path)
-    split_results = await split_dataframe(result, 100)
-    await write_graph(function, split_results, logger)
+    if metrics is not None:
+        metrics.record_read(len(result), time.perf_counter() - read_start)
+    incremental = is_incremental(function)
+    if incremental:
+        result, retracted_keys = await diff_against_state(function, result, logger)
+    start = time.perf_counter()
+    adaptive_config = config.get("adaptive_writes", {})
+    if adaptive_config.get("enabled"):
+        controller = AdaptiveBatchController(**{key: value for key, value in adaptive_config.items() if key != "enabled"})
+        settings, committed = await write_graph_adaptive(function, result, controller, logger, metrics)
+        logger.info(f"Adaptive write settings for {function.__name__} on {path}: {settings}")
+    else:
+        split_results = await split_dataframe(result, 100)
+        committed = await write_graph(function, split_results, logger, metrics)
+    if incremental:
+        # Rows of failed batches keep their previous state so the next run writes them again
+        written = result["RowKey"].isin(set(committed))
+        if not written.all():
+            logger.warning(f"{function.__name__}: {(~written).sum()} rows from {path} were not written and will be retried")
+        state_store.commit(function.__name__, result.loc[written, "RowKey"], result.loc[written, "RowHash"], retracted_keys)
+    elapsed = time.perf_counter() - start
+    logger.info(f"{function.__name__} wrote {len(result)} rows from {path} in {elapsed:0.2f} seconds "
+                f"({len(result) / max(elapsed, 1e-9):0.0f} rows/sec)")
     del result
 
+@flow
+async def streaming_subflow(path: str, function, chunk_rows: int, queue_size: int, writers: int):
+    # Reads the file in chunks of chunk_rows and hands them to the writers through a bounded
+    # queue, so the reader waits whenever the graph writes fall behind
+    logger = get_run_logger()
+    queue = asyncio.Queue(maxsize=queue_size)
+    reader = stream_data(path, chunk_rows)
+    metrics = load_metrics.dataset(function.__name__, path) if load_metrics is not None else None
+    written = 0
+
+    async def produce():
+        while True:
+            read_start = time.perf_counter()
+            chunk = await asyncio.to_thread(next, reader, None)
+            if chunk is None:
+                break
+            if metrics is not None:
+                metrics.record_read(len(chunk), time.perf_counter() - read_start)
+            await queue.put(chunk)
+        for _ in range(writers):
+            await queue.put(None)
+
+    async def consume():
+        nonlocal written
+        while (chunk := await queue.get()) is not None:
+            await function(chunk, logger, metrics)
+            written += len(chunk)
+
+    start = time.perf_counter()
+    await asyncio.gather(produce(), *[consume() for _ in range(writers)])
+    elapsed = time.perf_counter() - start
+    logger.info(f"{function.__name__} streamed {written} rows from {path} in {elapsed:0.2f} seconds "
+                f"({written / max(elapsed, 1e-9):0.0f} rows/sec)")
+
+@flow
+async def pipelined_subflow(path: str, function, chunk_rows: int, queue_size: int, writers: int):
+    # Batches of chunk_rows rows are decoded and transformed into payloads by the transform
+    # pool and handed to the writers through a bounded queue of queue_size batches, so the
+    # CPU work of the next batches overlaps the writes of the previous ones
+    logger = get_run_logger()
+    pool = get_transform_pool()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    metrics = load_metrics.dataset(function.__name__, path) if load_metrics is not None else None
+    written = 0
+
+    read_start = time.perf_counter()
+    rows = await loop.run_in_executor(pool, TransformWorkers.decode, path)
+    if metrics is not None:
+        metrics.record_read(rows, time.perf_counter() - read_start)
+
+    async def produce():
+        # The queue holds the pending payloads, a full queue stops new batches from being submitted
+        for offset in range(0, rows, chunk_rows):
+            await queue.put(loop.run_in_executor(pool, TransformWorkers.prepare, path, offset, chunk_rows,
+                                                 function.compiled, metrics is not None,
+                                                 metrics_config.get("exact_payload_bytes", False)))
+        for _ in range(writers):
+            await queue.put(None)
+
+    async def consume():
+        nonlocal written
+        while (prepared := await queue.get()) is not None:
+            data, transform_seconds, payload_bytes = await prepared
+            await function.write(data, transform_seconds, logger, metrics, payload_bytes)
+            written += len(data)
+
+    start = time.perf_counter()
+    await asyncio.gather(produce(), *[consume() for _ in range(writers)])
+    elapsed = time.perf_counter() - start
+    logger.info(f"{function.__name__} wrote {written} rows from {path} in {elapsed:0.2f} seconds "
+                f"({written / max(elapsed, 1e-9):0.0f} rows/sec) with {transform_processes()} transform processes")
+
+def build_subflow(name: str, path: str, function):
+    # Selects the whole-file, the streaming or the pipelined subflow according to the ingestion settings
+    ingestion = config.get("ingestion", {})
+    # Incremental loaders diff the whole file against the state store so they are never streamed or pipelined
+    incremental = is_incremental(function)
+    if ingestion.get("mode") == "streaming" and not incremental:
+        return streaming_subflow.with_options(name=name)(path, function, ingestion["chunk_rows"],
+                                                         ingestion["queue_size"], ingestion["writers"])
+    if ingestion.get("mode") == "pipelined" and not incremental:
+        return pipelined_subflow.with_options(name=name)(path, function, ingestion["chunk_rows"],
+                                                         ingestion["queue_size"], ingestion["writers"])
+    return subflow.with_options(name=name)(path, function)
+
+@flow(name="create-schema-flow")
+async def schema_flow(schema_config: dict):
+    logger = get_run_logger()
+    await asyncio.gather(*[create_constraint(item, logger) for item in schema_config.get("constraints", [])])
+    await asyncio.gather(*[create_index(item, logger) for item in schema_config.get("indexes", [])])
+    pending = await await_indexes(schema_config.get("await_indexes_timeout", 300), logger)
+    if pending:
+        for record in pending:
+            logger.warning(f"Index {record['name']} is {record['state']} ({record['populationPercent']:0.1f}% populated)")
+    else:
+        logger.info("All indexes are ONLINE")
+
+@flow(name="build-projections-flow")
+async def projection_flow(projection_config: dict):
+    logger = get_run_logger()
+    await asyncio.gather(*[create_index(item, logger) for item in projection_config.get("indexes", [])])
+
+    async def build(name):
+        s = time.perf_counter()
+        summaries = await build_projection(name, logger)
+        elapsed = time.perf_counter() - s
+        counters = [summary.counters for summary in summaries or [] if summary is not None]
+        logger.info(f"Projection {name} built in {elapsed:0.2f} seconds: "
+                    f"{sum(c.nodes_created for c in counters)} nodes and "
+                    f"{sum(c.relationships_created for c in counters)} relationships created")
+
+    await asyncio.gather(*[build(name) for name in projection_config.get("build", [])])
+
+@task(name="report-edge-phase", description="Compares the edge job durations with and without the schema stage")
+async def report_edge_phase(edge_seconds: dict, measure: str, schema_enabled: bool, timings_file: str, logger):
+    # Edge jobs overlap the node jobs they do not depend on, so the edge phase is measured
+    # as the sum over the edge jobs of their write time, or of their subflow duration
+    # without load metrics. Runs are only compared with a baseline of the same measure
+    timings = {}
+    if os.path.exists(timings_file):
+        with open(timings_file, "r") as file:
+            timings = json.load(file)
+    elapsed = sum(edge_seconds.values())
+    with_schema, without_schema = f"edge_{measure}_with_schema", f"edge_{measure}_without_schema"
+    timings[with_schema if schema_enabled else without_schema] = elapsed
+    with open(timings_file, "w") as file:
+        json.dump(timings, file)
+    slowest = sorted(edge_seconds.items(), key=lambda item: item[1], reverse=True)[:5]
+    logger.info(f"{len(edge_seconds)} edge jobs took {elapsed:0.2f} seconds of {measure} time in total. Slowest: "
+                + ", ".join(f"{name} {seconds:0.2f}s" for name, seconds in slowest))
+    if with_schema in timings and without_schema in timings:
+        saved = timings[without_schema] - timings[with_schema]
+        logger.info(f"Schema stage saved {saved:0.2f} seconds of edge {measure} time "
+                    f"({timings[without_schema]:0.2f}s without schema, {timings[with_schema]:0.2f}s with schema)")
+    else:
+        logger.info("Run the pipeline once with schema.enabled set to false to record a baseline of the edge jobs")
+
+def plan_jobs(load_nodes: list, load_relationships: list, fused: bool):
+    # One job per dataset of every loader with the node and relationship types it reads and writes
+    jobs = []
+    fused_nodes = [name for name in load_nodes if fused and engine.is_row_node(name)]
+    folded = {rel_name for name in fused_nodes for rel_name in engine.row_relationships(name)}
+
+    def add_jobs(name, definition, loader, reads, writes, edges):
+        for path in engine.dataset_paths(definition):
+            jobs.append({"name": f"{loader.__name__} from {os.path.basename(path)}", "path": path, "loader": loader,
+                         "reads": reads, "writes": writes, "edges": edges})
+
+    for name in load_nodes:
+        if name not in fused_nodes:
+            add_jobs(name, engine.model["nodes"][name], build_loader(engine.node_query(name)), set(), {name}, False)
+    for name in load_relationships:
+        if name not in folded:
+            relationship = engine.model["relationships"][name]
+            add_jobs(name, relationship, build_loader(engine.relationship_query(name)),
+                     {relationship["start"]["node"], relationship["end"]["node"]}, {name}, True)
+    # Fused loaders read the keyed endpoints of the relationships folded into them
+    for name in fused_nodes:
+        relationships = [rel_name for rel_name in engine.row_relationships(name) if rel_name in load_relationships]
+        endpoints = {endpoint["node"] for rel_name in relationships
+                     for endpoint in (engine.model["relationships"][rel_name]["start"], engine.model["relationships"][rel_name]["end"])}
+        add_jobs(name, engine.model["nodes"][name], build_loader(engine.fused_query(name, relationships)),
+                 endpoints - {name}, {name, *relationships}, True)
+    # A job waits for every job writing a type it reads. Types not loaded in this run are assumed to exist
+    for job in jobs:
+        job["depends_on"] = [other["name"] for other in jobs if other is not job and other["writes"] & job["reads"]]
+    return jobs
+
+async def run_jobs(jobs: list, max_concurrent: int, logger):
+    # Starts every job as soon as the jobs it depends on are finished, with at most
+    # max_concurrent subflows running at the same time. Jobs depending on a failed or
+    # skipped job are skipped, as their MATCH on the missing nodes would create nothing
+    loop = asyncio.get_running_loop()
+    succeeded = {job["name"]: loop.create_future() for job in jobs}
+    timings = {}
+    skipped = []
+    semaphore = asyncio.Semaphore(max_concurrent)
+    origin = time.perf_counter()
+
+    async def run(job):
+        try:
+            outcomes = await asyncio.gather(*[succeeded[name] for name in job["depends_on"]])
+            failed = [name for name, ok in zip(job["depends_on"], outcomes) if not ok]
+            if failed:
+                skipped.append(job["name"])
+                logger.error(f'Skipped {job["name"]}, it depends on {", ".join(failed)} which did not load')
+                succeeded[job["name"]].set_result(False)
+                return
+            async with semaphore:
+                start = time.perf_counter() - origin
+                await build_subflow(f'Subflow for {job["name"]}', job["path"], job["loader"])
+                timings[job["name"]] = (start, time.perf_counter() - origin)
+            succeeded[job["name"]].set_result(True)
+        except BaseException as e:
+            logger.error(f'Subflow for {job["name"]} failed: {e}')
+            succeeded[job["name"]].set_result(False)
+            raise
+
+    results = await asyncio.gather(*[run(job) for job in jobs], return_exceptions=True)
+    log_critical_path(jobs, timings, logger)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.error(f"{len(errors)} subflows failed and {len(skipped)} were skipped: {', '.join(skipped) or 'none'}")
+        raise errors[0]
+    return timings
+
+def log_critical_path(jobs: list, timings: dict, logger):
+    # Walks back from the last job to finish through the dependency that finished last
+    # Nothing to report when no subflow ran, as when the load lists are empty
+    if not timings:
+        return
+    by_name = {job["name"]: job for job in jobs}
+    current = max(timings, key=lambda name: timings[name][1])
+    path = [current]
+    while True:
+        dependencies = [name for name in by_name[current]["depends_on"] if name in timings]
+        if not dependencies:
+            break
+        current = max(dependencies, key=lambda name: timings[name][1])
+        path.append(current)
+    steps = [f"{name} ({timings[name][0]:0.2f}s-{timings[name][1]:0.2f}s)" for name in reversed(path)]
+    logger.info(f"Loaded {len(timings)} subflows in {timings[path[0]][1]:0.2f} seconds. Critical path: {' -> '.join(steps)}")
+
+@task(name="export-load-metrics", description="Writes the load metrics file and publishes them as Prefect artifacts")
+async def export_metrics(metrics_file: str, logger):
+    report = load_metrics.report()
+    with open(metrics_file, "w") as file:
+        json.dump(report, file, indent=2)
+    if report["datasets"]:
+        await create_table_artifact(key="load-metrics", table=report["datasets"],
+                                    description="Read, transform and write measurements per loader and dataset")
+    totals = report["datasets"]
+    failed = sum(item["transactions_failed"] + item["failed_batches"] for item in totals)
+    client_seconds = sum(item["client_seconds"] for item in totals)
+    db_seconds = sum(item["db_seconds"] for item in totals)
+    logger.info(f"Summed over datasets: read {sum(item['read_seconds'] for item in totals):0.2f}s, transform "
+                f"{sum(item['transform_seconds'] for item in totals):0.2f}s, write {client_seconds:0.2f}s of which "
+                f"{db_seconds:0.2f}s in the database. Metrics written to {metrics_file}")
+    if failed:
+        logger.warning(f"{failed} failed batches or inner transactions, see {metrics_file}")
+
 @flow(name="create-graph-flow",log_prints=True)
 async def main_flow():
     # Configure the pipeline to load the desired data to the graph
-    # Create and run node subflows
-    node_subflows = []
-    for item in config["create_nodes_functions"]:
-        file_path = item["file_path"]
-        function_name = function_parser.get(item["function"])
-        node_type = item["node_type"]
-        if node_type.startswith('visit'):
-            visit_datasets = ['adlbc.xpt', 'adlbh.xpt', 'advs.xpt', 'adadas.xpt', 'adcibc.xpt']
-            for i in visit_datasets:
-                sub = subflow.with_options(name=f'Subflow for {node_type} nodes')(file_path+i, function_name)
-                node_subflows.append(sub)
-        else:
-            sub = subflow.with_options(name=f'Subflow for {node_type} nodes')(file_path, function_name)
-            node_subflows.append(sub)
-    await asyncio.gather(*node_subflows)
-    edges_subflows = []
-    for item in config["create_edges_functions"]:
-        file_path = item["file_path"]
-        function_name = function_parser.get(item["function"])
-        edge_type = item["edge_type"]
-        if edge_type.startswith('visit'):
-            visit_datasets = ['adlbc.xpt', 'adlbh.xpt', 'advs.xpt', 'adadas.xpt', 'adcibc.xpt']
-            for i in visit_datasets:
-                sub = subflow.with_options(name=f'Subflow for {edge_type} edges')(file_path+i, function_name)
-                edges_subflows.append(sub)
-        else:
-            sub = subflow.with_options(name=f'Subflow for {edge_type} edges')(file_path, function_name)
-            edges_subflows.append(sub)
-    await asyncio.gather(*edges_subflows)
+    logger = get_run_logger()
+    schema_config = config.get("schema", {})
+    schema_enabled = schema_config.get("enabled", False)
+    if load_metrics is not None:
+        load_metrics.reset()
+    # Create constraints and indexes before any node or edge is written
+    if schema_enabled:
+        await schema_flow(schema_config)
+    # In fused mode row nodes are created together with their relationships to keyed nodes
+    fused = config.get("loading_mode", "two_pass") == "fused"
+    if state_store is not None and not fused:
+        raise ValueError("Incremental loads require loading_mode: fused so measurement edges are rewritten with their nodes")
+    if config.get("graph_layout", "standard") != "standard" and not fused:
+        raise ValueError("The compact graph layout requires loading_mode: fused as its measurement nodes cannot be rematched on their properties")
+    if config.get("ingestion", {}).get("mode") == "pipelined" and xpt_cache is None:
+        raise ValueError("Pipelined ingestion requires the XPT cache, its workers read row ranges of the cached Arrow files")
+    jobs = plan_jobs(config["load"]["nodes"], config["load"]["relationships"], fused)
+    timings = await run_jobs(jobs, config.get("scheduling", {}).get("max_concurrent_subflows", 8), logger)
+    # Write time of each job writing relationships from the load metrics, or its subflow duration
+    edge_jobs = [job for job in jobs if job["edges"]]
+    if load_metrics is not None:
+        written = {(item["loader"], item["path"]): item["client_seconds"] for item in load_metrics.report()["datasets"]}
+        edge_seconds = {job["name"]: written.get((job["loader"].__name__, job["path"]), 0.0) for job in edge_jobs}
+        measure = "write"
+    else:
+        edge_seconds = {job["name"]: timings[job["name"]][1] - timings[job["name"]][0] for job in edge_jobs}
+        measure = "subflow"
+    if edge_seconds:
+        await report_edge_phase(edge_seconds, measure, schema_enabled,
+                                schema_config.get("timings_file", "./edge_phase_timings.json"), logger)
+    # Text and range indexes for the filters of the generated queries are built once the data is loaded
+    search_config = config.get("search_indexes", {})
+    if search_config.get("enabled"):
+        await schema_flow.with_options(name="create-search-indexes-flow")(search_config)
+    # Summary projections are rebuilt from the loaded graph before the QA service sees the new version
+    projection_config = config.get("projections", {})
+    if projection_config.get("enabled"):
+        await projection_flow(projection_config)
+    version = await bump_graph_version(logger)
+    logger.info(f"Graph version stamp set to {version}")
+    if load_metrics is not None:
+        await export_metrics(metrics_config.get("file", "./load_metrics.json"), logger)
 
 if __name__ == "__main__":
     import time
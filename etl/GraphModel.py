@@ -0,0 +1,212 @@
+import json
+import pandas as pd
+
+# Helpers shared by the loaders built from the graph_model section of pipeline_config.yaml
+
+def apply_layout(config: dict):
+    # Returns the configuration with the section of its graph_layout applied. Its nodes and
+    # relationships replace or extend those of graph_model, new ones are added to the load
+    # lists, and its schema and search index entries extend those sections
+    layout_name = config.get("graph_layout", "standard")
+    if layout_name == "standard":
+        return config
+    layout = config[f"{layout_name}_layout"]
+    for section in ("nodes", "relationships"):
+        definitions = layout.get(section, {})
+        config["graph_model"][section].update(definitions)
+        config["load"][section] += [name for name in definitions if name not in config["load"][section]]
+    for section in ("schema", "search_indexes"):
+        for kind in ("constraints", "indexes"):
+            entries = layout.get(section, {}).get(kind, [])
+            if entries:
+                config.setdefault(section, {}).setdefault(kind, []).extend(entries)
+    return config
+
+def project(df: pd.DataFrame, mapping: dict):
+    # Returns one column per property taken from its source column. Source columns missing
+    # from a dataset (e.g. CHG in adcibc) become nulls as they did in the Cypher loaders
+    return pd.DataFrame({prop: df[column] if column in df.columns else pd.Series(None, index=df.index, dtype=object)
+                         for prop, column in mapping.items()}, index=df.index)
+
+def node_key_columns(node: dict):
+    # Source columns of the key properties of a keyed node
+    return [node["properties"][prop] for prop in node["key"]]
+
+def endpoint_key_columns(model: dict, endpoint: dict):
+    # Source columns matched against the key properties of a relationship endpoint
+    node = model["nodes"][endpoint["node"]]
+    return [endpoint["match"][prop] for prop in node["key"]]
+
+def key_ids(df: pd.DataFrame, columns: list):
+    # Identifier of a keyed node, the key values joined with |
+    ids = df[columns[0]].astype(str)
+    for column in columns[1:]:
+        ids = ids + "|" + df[column].astype(str)
+    return ids
+
+def payload_bytes(data: list, exact=False, sample_rows=32):
+    # Size of the payload rows as JSON, estimated from sample_rows rows spread over the
+    # batch so the load metrics do not serialise every batch twice
+    if exact or len(data) <= sample_rows:
+        return len(json.dumps(data, default=str))
+    step = len(data) / sample_rows
+    sample = [data[int(index * step)] for index in range(sample_rows)]
+    return round(len(json.dumps(sample, default=str)) * len(data) / sample_rows)
+
+def row_ids(dataset: str, df: pd.DataFrame):
+    # Identifier of a node created once per row, the dataset name and the row position
+    return dataset + ":" + pd.Series(range(len(df)), index=df.index).astype(str)
+
+
+class CompiledQuery:
+    # A Cypher statement compiled once from the graph model together with the source
+    # columns it reads. Rows are sent as positional lists of only those columns.
+
+    def __init__(self, name, query, columns, constants=None, dedupe=None, required=None):
+        self.name = name
+        self.query = query
+        self.columns = columns
+        self.constants = constants or {}
+        self.dedupe = dedupe
+        self.required = required
+
+    def payload(self, df: pd.DataFrame):
+        frame = project(df, {column: column for column in self.columns})
+        # MERGE on a null key fails the whole inner transaction, so rows without a key are skipped
+        if self.required:
+            frame = frame.dropna(subset=self.required)
+        if self.dedupe:
+            frame = frame.drop_duplicates(subset=self.dedupe, keep="last")
+        return frame.values.tolist()
+
+
+class MappingEngine:
+    # Compiles the node and relationship definitions of the graph model into Cypher
+    # loaders. Nodes with a key are merged on it, row nodes are created once per row and
+    # can be fused with the relationships that attach them to keyed nodes.
+
+    def __init__(self, model: dict, row_key_nodes=()):
+        self.model = model
+        self.__row_key_nodes = set(row_key_nodes)
+        self.__compiled = {}
+
+    def is_row_node(self, name: str):
+        return not self.model["nodes"][name].get("key")
+
+    def row_relationships(self, name: str):
+        # Relationships whose start or end is the row node built from the same row
+        return [rel_name for rel_name, rel in self.model["relationships"].items()
+                if any(endpoint["node"] == name and "match" not in endpoint for endpoint in (rel["start"], rel["end"]))]
+
+    def dataset_paths(self, definition: dict):
+        return [self.model["datasets"][dataset] for dataset in definition["datasets"]]
+
+    def node_query(self, name: str):
+        if name not in self.__compiled:
+            self.__compiled[name] = self.__compile_node(name, [])
+        return self.__compiled[name]
+
+    def fused_query(self, name: str, relationships: list):
+        key = (name, tuple(relationships))
+        if key not in self.__compiled:
+            self.__compiled[key] = self.__compile_node(name, relationships)
+        return self.__compiled[key]
+
+    def relationship_query(self, name: str):
+        if name not in self.__compiled:
+            self.__compiled[name] = self.__compile_relationship(name)
+        return self.__compiled[name]
+
+    def __row(self, columns: list, column: str):
+        # Positional reference to a source column in the row payload
+        if column not in columns:
+            columns.append(column)
+        return f"row[{columns.index(column)}]"
+
+    def __properties(self, columns: list, mapping: dict, constants: dict):
+        items = [f"{prop}: {self.__row(columns, column)}" for prop, column in mapping.items()]
+        items += [f"{prop}: $constants.{prop}" for prop in constants]
+        return "{" + ", ".join(items) + "}" if items else ""
+
+    def __relationship(self, variable: str, columns: list, rel: dict):
+        properties = self.__properties(columns, rel.get("properties", {}), {})
+        return f"[{variable}:{rel['type']} {properties}]" if properties else f"[{variable}:{rel['type']}]"
+
+    def __pattern(self, variable: str, columns: list, endpoint: dict):
+        node = self.model["nodes"][endpoint["node"]]
+        match = {prop: endpoint["match"][prop] for prop in node["key"]}
+        return f"({variable}:{node['labels'][0]} {self.__properties(columns, match, {})})"
+
+    def __wrap(self, body: str, variable: str):
+        return f'''
+    UNWIND $rows AS row
+    CALL {{
+    WITH row
+    {body}
+    RETURN {variable}
+    }} IN TRANSACTIONS OF 10000 ROWS
+    ON ERROR CONTINUE
+    REPORT STATUS AS s
+    RETURN s.transactionId AS transactionId, s.started AS started, s.committed AS committed, s.errorMessage AS errorMessage, count(*) AS rows
+    '''
+
+    def __compile_node(self, name: str, relationships: list):
+        node = self.model["nodes"][name]
+        labels = ":".join(node["labels"])
+        constants = node.get("constants", {})
+        columns = []
+        if node.get("key"):
+            key = {prop: node["properties"][prop] for prop in node["key"]}
+            body = f"MERGE (n:{labels} {self.__properties(columns, key, {})})"
+            updates = [f"n.{prop} = {self.__row(columns, column)}"
+                       for prop, column in node["properties"].items() if prop not in key]
+            updates += [f"n.{prop} = $constants.{prop}" for prop in constants]
+            if name in self.__row_key_nodes:
+                updates.append(f"n.RowKey = {self.__row(columns, 'RowKey')}")
+            if updates:
+                body += "\n    SET " + ", ".join(updates)
+            key_columns = node_key_columns(node)
+            return CompiledQuery(name, self.__wrap(body, "n"), columns, constants, dedupe=key_columns, required=key_columns)
+        mapping = dict(node["properties"])
+        if name in self.__row_key_nodes:
+            mapping["RowKey"] = "RowKey"
+        body = f"CREATE (n:{labels} {self.__properties(columns, mapping, constants)})"
+        # Fused loading attaches the new node to its keyed endpoints in the same pass
+        if relationships:
+            patterns, creates = [], []
+            for index, rel_name in enumerate(relationships):
+                rel = self.model["relationships"][rel_name]
+                other = rel["start"] if rel["end"]["node"] == name and "match" not in rel["end"] else rel["end"]
+                patterns.append(self.__pattern(f"m{index}", columns, other))
+                relationship = self.__relationship("", columns, rel)
+                if other is rel["start"]:
+                    creates.append(f"CREATE (m{index})-{relationship}->(n)")
+                else:
+                    creates.append(f"CREATE (n)-{relationship}->(m{index})")
+            body += "\n    WITH row, n\n    MATCH " + ", ".join(patterns) + "\n    " + "\n    ".join(creates)
+        return CompiledQuery(name, self.__wrap(body, "n"), columns, constants)
+
+    def __compile_relationship(self, name: str):
+        rel = self.model["relationships"][name]
+        columns = []
+        constants = {}
+        patterns = []
+        for variable, endpoint in (("a", rel["start"]), ("b", rel["end"])):
+            if "match" in endpoint:
+                patterns.append(self.__pattern(variable, columns, endpoint))
+            else:
+                # Two-pass loading rematches the row node on all of its properties
+                node = self.model["nodes"][endpoint["node"]]
+                constants = node.get("constants", {})
+                patterns.append(f"({variable}:{':'.join(node['labels'])} "
+                                f"{self.__properties(columns, node['properties'], constants)})")
+        body = "MATCH " + ", ".join(patterns)
+        keyed = "match" in rel["start"] and "match" in rel["end"]
+        if keyed:
+            body += f"\n    MERGE (a)-[r:{rel['type']}]->(b)"
+            if rel.get("properties"):
+                body += f"\n    SET r += {self.__properties(columns, rel['properties'], {})}"
+            match_columns = endpoint_key_columns(self.model, rel["start"]) + endpoint_key_columns(self.model, rel["end"])
+            return CompiledQuery(name, self.__wrap(body, "r"), columns, constants, dedupe=match_columns, required=match_columns)
+        body += f"\n    CREATE (a)-{self.__relationship('r', columns, rel)}->(b)"
+        return CompiledQuery(name, self.__wrap(body, "r"), columns, constants)
@@ -0,0 +1,78 @@
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import yaml
+
+# Latency of the Cypher of the QA example questions on the database of NEO4J_URI, without
+# and with the indexes of the search_indexes section of pipeline_config.yaml. The
+# indexes are dropped for the first measurement and created again for the second one
+
+import ETLfunctions
+from ETLfunctions import create_index, await_indexes
+import logging
+
+logger = logging.getLogger("index-benchmark")
+
+with open("pipeline_config.yaml", "r") as file:
+    search_config = yaml.safe_load(file).get("search_indexes", {})
+
+def operators(plan: dict):
+    names = [plan["operatorType"].split("@")[0]]
+    for child in plan.get("children", []):
+        names.extend(operators(child))
+    return names
+
+async def measure_examples(examples: list, repeat: int):
+    # Median wall time over repeat runs after a warm-up run that plans the query, and the
+    # index operators of the plan
+    results = {}
+    for example in examples:
+        explained = await ETLfunctions.conn.query(f"EXPLAIN {example['cypher']}", db=ETLfunctions.db, consume="summary")
+        if explained is None:
+            print(f"Skipped, the query failed: {example['question']}")
+            continue
+        await ETLfunctions.conn.query(example["cypher"], db=ETLfunctions.db, consume="summary")
+        timings = []
+        for _ in range(repeat):
+            s = time.perf_counter()
+            await ETLfunctions.conn.query(example["cypher"], db=ETLfunctions.db, consume="summary")
+            timings.append((time.perf_counter() - s) * 1000)
+        results[example["question"]] = {"median_ms": round(statistics.median(timings), 2),
+                                        "index_operators": sorted({name for name in operators(explained.plan) if "Index" in name})}
+    return results
+
+async def drop_indexes(indexes: list):
+    for index in indexes:
+        await ETLfunctions.conn.query(f"DROP INDEX {index['name']} IF EXISTS", db=ETLfunctions.db, consume="summary")
+
+async def run(examples: list, repeat: int):
+    indexes = search_config.get("indexes", [])
+    await drop_indexes(indexes)
+    before = await measure_examples(examples, repeat)
+    await asyncio.gather(*[create_index(index, logger) for index in indexes])
+    await await_indexes(search_config.get("await_indexes_timeout", 300), logger)
+    after = await measure_examples(examples, repeat)
+    comparison = {}
+    for question, result in after.items():
+        if question not in before:
+            continue
+        comparison[question] = {"without_indexes_ms": before[question]["median_ms"], "with_indexes_ms": result["median_ms"],
+                                "speedup": round(before[question]["median_ms"] / result["median_ms"], 2) if result["median_ms"] else None,
+                                "index_operators": result["index_operators"]}
+        print(f"{before[question]['median_ms']:>10.2f} ms {result['median_ms']:>10.2f} ms  {question}")
+    return comparison
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the latency of the example questions without and with the search indexes")
+    parser.add_argument("--examples", default="../src/cypherQAchain/examples.yaml")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", default="./index_benchmark.json")
+    args = parser.parse_args()
+    with open(args.examples, "r") as file:
+        examples = yaml.safe_load(file)
+    print("   without       with  question")
+    comparison = asyncio.run(run(examples, args.repeat))
+    with open(args.output, "w") as file:
+        json.dump(comparison, file, indent=2)
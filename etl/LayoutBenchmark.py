@@ -0,0 +1,142 @@
+import os
+import json
+import asyncio
+import argparse
+import yaml
+import pandas as pd
+
+# Compares the standard and compact graph layouts of pipeline_config.yaml on the synthetic
+# datasets of SyntheticData.py. For each layout main_flow loads the datasets and the stored
+# nodes, relationships, property values and string bytes are estimated from the datasets.
+# With --neo4j they are counted in the database of NEO4J_URI instead, which is cleared
+# before each layout, together with the size of its store directory and the latency of
+# the Cypher of the QA examples written for the layout
+
+import ETLfunctions
+import GraphETLpipeline as pipeline
+from GraphModel import MappingEngine, apply_layout, project
+from Benchmark import RecordingConnection, measure, read_dataset, clear_database
+from IndexBenchmark import measure_examples
+
+LAYOUTS = ("standard", "compact")
+
+STORE_QUERIES = {
+    "nodes": "MATCH (n) RETURN count(n) AS value",
+    "relationships": "MATCH ()-[r]->() RETURN count(r) AS value",
+    "properties": "MATCH (n) RETURN sum(size(keys(n))) AS value",
+    "relationship_properties": "MATCH ()-[r]->() RETURN sum(size(keys(r))) AS value",
+    "string_bytes": "MATCH (n) UNWIND keys(n) AS key WITH n[key] AS value WHERE value IS :: STRING RETURN sum(size(value)) AS value",
+}
+
+def use_layout(layout: str, data: str):
+    # Points the pipeline at a configuration with the layout applied and the synthetic datasets.
+    # Incremental loads are left out so that every layout writes every row
+    with open("pipeline_config.yaml", "r") as file:
+        config = yaml.safe_load(file)
+    config["graph_layout"] = layout
+    config = apply_layout(config)
+    for name in config["graph_model"]["datasets"]:
+        config["graph_model"]["datasets"][name] = os.path.join(data, f"{name}.xpt")
+    pipeline.config = config
+    pipeline.state_store = None
+    pipeline.engine = MappingEngine(config["graph_model"])
+    return config
+
+def add_values(totals: dict, values: pd.DataFrame, constants: dict):
+    # Null values are not stored by Neo4j
+    totals["properties"] += int(values.notna().sum().sum()) + len(constants) * len(values)
+    for column in values.columns:
+        totals["string_bytes"] += sum(len(value) for value in values[column] if isinstance(value, str))
+    totals["string_bytes"] += sum(len(value) for value in constants.values() if isinstance(value, str)) * len(values)
+
+async def estimate_store(config: dict):
+    # Nodes, relationships, property values and string bytes of the loaded model. Keyed
+    # nodes and relationships between keyed nodes are merged, so they are counted once
+    model = config["graph_model"]
+    frames = {name: await read_dataset(path) for name, path in model["datasets"].items()}
+    totals = {"nodes": 0, "relationships": 0, "properties": 0, "string_bytes": 0}
+    for name in config["load"]["nodes"]:
+        node = model["nodes"][name]
+        values = pd.concat([project(frames[dataset], node["properties"]) for dataset in node["datasets"]], ignore_index=True)
+        if node.get("key"):
+            values = values.dropna(subset=node["key"]).drop_duplicates(subset=node["key"])
+        totals["nodes"] += len(values)
+        add_values(totals, values, node.get("constants", {}))
+    for name in config["load"]["relationships"]:
+        relationship = model["relationships"][name]
+        for dataset in relationship["datasets"]:
+            df = frames[dataset]
+            if "match" in relationship["start"] and "match" in relationship["end"]:
+                df = df.drop_duplicates(subset=[column for side in ("start", "end") for column in relationship[side]["match"].values()])
+            totals["relationships"] += len(df)
+            add_values(totals, project(df, relationship.get("properties", {})), {})
+    return totals
+
+async def count_store(connection, store_dir: str):
+    totals = {}
+    for name, query in STORE_QUERIES.items():
+        records = await connection.query(query, db=ETLfunctions.db)
+        totals[name] = records[0]["value"] if records else None
+    totals["properties"] = (totals["properties"] or 0) + (totals.pop("relationship_properties") or 0)
+    if store_dir:
+        # The checkpoint flushes the page cache so that the store files hold the loaded graph
+        await connection.query("CALL db.checkpoint()", db=ETLfunctions.db, consume="summary")
+        totals["store_bytes"] = sum(os.path.getsize(os.path.join(root, file))
+                                    for root, _, files in os.walk(store_dir) for file in files)
+    return totals
+
+def layout_examples(examples: list, layout: str):
+    # The compact layout has ParameterDefinition nodes, the examples excluding them are for the standard one
+    if layout == "compact":
+        return [example for example in examples if "ParameterDefinition" not in example.get("excludes", [])]
+    return [example for example in examples if "ParameterDefinition" not in example.get("requires", [])]
+
+async def run(data: str, neo4j: bool, latency: float, store_dir: str, examples: list, repeat: int):
+    target = ETLfunctions.conn if neo4j else None
+    results = {}
+    for layout in LAYOUTS:
+        config = use_layout(layout, data)
+        recorder = RecordingConnection(target, latency)
+        ETLfunctions.conn = recorder
+        if target is not None:
+            await clear_database(target)
+        stages = {}
+        await measure(stages, f"main_flow {layout}", recorder, pipeline.main_flow())
+        results[layout] = {"load": stages[f"main_flow {layout}"]}
+        if target is not None:
+            ETLfunctions.conn = target
+            results[layout]["store"] = await count_store(target, store_dir)
+            results[layout]["latency"] = await measure_examples(layout_examples(examples, layout), repeat)
+        else:
+            results[layout]["store"] = await estimate_store(config)
+        print(f"{layout}: {results[layout]['store']}")
+    standard, compact = results["standard"]["store"], results["compact"]["store"]
+    results["compact_to_standard"] = {name: round(compact[name] / standard[name], 3)
+                                      for name in standard if standard[name] and compact.get(name) is not None}
+    results["compact_to_standard"]["load_seconds"] = round(results["compact"]["load"]["seconds"] / results["standard"]["load"]["seconds"], 3)
+    results["compact_to_standard"]["bytes_sent"] = round(results["compact"]["load"]["bytes_sent"] / results["standard"]["load"]["bytes_sent"], 3)
+    if target is not None:
+        # Latency of the questions answered in both layouts
+        questions = [question for question in results["standard"]["latency"] if question in results["compact"]["latency"]]
+        for question in questions:
+            before, after = results["standard"]["latency"][question]["median_ms"], results["compact"]["latency"][question]["median_ms"]
+            print(f"{before:>10.2f} ms {after:>10.2f} ms  {question}")
+    print(f"compact / standard: {results['compact_to_standard']}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the store size and query latency of the standard and compact graph layouts")
+    parser.add_argument("--data", default="./benchmark_data", help="Directory written by SyntheticData.py")
+    parser.add_argument("--neo4j", action="store_true",
+                        help="Loads the database of NEO4J_URI, which is cleared before each layout")
+    parser.add_argument("--store-dir", default="", help="Store directory of the database, to measure its size on disk with --neo4j")
+    parser.add_argument("--latency", type=float, default=0.001, help="Seconds per statement of the stand-in driver")
+    parser.add_argument("--examples", default="../src/cypherQAchain/examples.yaml")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", default="./layout_benchmark.json")
+    args = parser.parse_args()
+    with open(args.examples, "r") as file:
+        examples = yaml.safe_load(file)
+    results = asyncio.run(run(args.data, args.neo4j, args.latency, args.store_dir, examples, args.repeat))
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
@@ -0,0 +1,175 @@
+import os
+import argparse
+import struct
+import time
+import datetime
+import numpy as np
+import pandas as pd
+
+# Writes synthetic ADSL, ADAE, ADLBC, ADLBH, ADVS, ADADAS and ADCIBC datasets with the
+# columns read by the graph_model loaders, from the size of the CDISC pilot study up to
+# millions of rows, for the ETL benchmarks in Benchmark.py
+
+ARMS = {"Placebo": 0.0, "Xanomeline Low Dose": 54.0, "Xanomeline High Dose": 81.0}
+VISITS = ["SCREENING 1", "BASELINE", "WEEK 2", "WEEK 4", "WEEK 6", "WEEK 8", "WEEK 12",
+          "WEEK 16", "WEEK 20", "WEEK 24", "WEEK 26"]
+CHEMISTRY = {"ALB": "Albumin (g/L)", "ALP": "Alkaline Phosphatase (U/L)", "ALT": "Alanine Aminotransferase (U/L)",
+             "AST": "Aspartate Aminotransferase (U/L)", "BILI": "Bilirubin (umol/L)", "BUN": "Blood Urea Nitrogen (mmol/L)",
+             "CA": "Calcium (mmol/L)", "CHOL": "Cholesterol (mmol/L)", "CREAT": "Creatinine (umol/L)",
+             "GLUC": "Glucose (mmol/L)", "K": "Potassium (mmol/L)", "SODIUM": "Sodium (mmol/L)"}
+HEMATOLOGY = {"BASO": "Basophils (GI/L)", "EOS": "Eosinophils (GI/L)", "HCT": "Hematocrit", "HGB": "Hemoglobin (mmol/L)",
+              "LYM": "Lymphocytes (GI/L)", "MONO": "Monocytes (GI/L)", "PLAT": "Platelet (GI/L)",
+              "RBC": "Erythrocytes (TI/L)", "WBC": "Leukocytes (GI/L)"}
+VITAL_SIGNS = {"DIABP": "Diastolic Blood Pressure (mmHg)", "PULSE": "Pulse Rate (beats/min)",
+               "SYSBP": "Systolic Blood Pressure (mmHg)", "TEMP": "Temperature (C)", "WEIGHT": "Weight (kg)"}
+ADAS = {"ACTOT": "Adas-Cog(11) Subscore", "ACITM01": "Word Recall Task", "ACITM02": "Naming Objects And Fingers",
+        "ACITM03": "Delayed Word Recall", "ACITM04": "Commands"}
+ADVERSE_EVENTS = {"APPLICATION SITE PRURITUS": "GENERAL DISORDERS AND ADMINISTRATION SITE CONDITIONS",
+                  "APPLICATION SITE ERYTHEMA": "GENERAL DISORDERS AND ADMINISTRATION SITE CONDITIONS",
+                  "DIARRHOEA": "GASTROINTESTINAL DISORDERS", "NAUSEA": "GASTROINTESTINAL DISORDERS",
+                  "DIZZINESS": "NERVOUS SYSTEM DISORDERS", "HEADACHE": "NERVOUS SYSTEM DISORDERS",
+                  "ERYTHEMA": "SKIN AND SUBCUTANEOUS TISSUE DISORDERS", "PRURITUS": "SKIN AND SUBCUTANEOUS TISSUE DISORDERS",
+                  "SINUS BRADYCARDIA": "CARDIAC DISORDERS", "UPPER RESPIRATORY TRACT INFECTION": "INFECTIONS AND INFESTATIONS"}
+
+def visit_names(count: int):
+    # The pilot visit schedule, extended with later weeks for larger studies
+    return VISITS[:count] + [f"WEEK {26 + 2 * week}" for week in range(1, count - len(VISITS) + 1)]
+
+def ibm_float(values: np.ndarray):
+    # IEEE 754 doubles to the IBM hexadecimal floats of SAS transport files. Missing
+    # values are written as the SAS missing value "."
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    ieee = np.where(missing, 0.0, values).view(np.uint64)
+    sign = ieee & np.uint64(0x8000000000000000)
+    exponent = ((ieee >> np.uint64(52)) & np.uint64(0x7FF)).astype(np.int64) - 1023
+    mantissa = ((ieee & np.uint64(0x000FFFFFFFFFFFFF)) | np.uint64(0x0010000000000000)) << np.uint64(3)
+    ibm_exponent = -(-(exponent + 1) // 4)
+    shift = (4 * ibm_exponent - 1 - exponent).astype(np.uint64)
+    ibm = sign | ((ibm_exponent + 64).astype(np.uint64) << np.uint64(56)) | (mantissa >> shift)
+    ibm = np.where(values == 0, np.uint64(0), ibm)
+    return np.where(missing, np.uint64(0x2E00000000000000), ibm)
+
+def header(text: str):
+    return f"HEADER RECORD*******{text:<8}HEADER RECORD!!!!!!!".encode("ascii")
+
+def padded(data: bytes, fill: bytes = b" "):
+    return data + fill * (-len(data) % 80)
+
+def write_xpt(df: pd.DataFrame, path: str, name: str):
+    # Writes a single member SAS transport (XPORT v5) file that pd.read_sas reads back
+    stamp = datetime.datetime.now().strftime("%d%b%y:%H:%M:%S").upper().encode("ascii")
+    lengths, fields = [], []
+    for column in df.columns:
+        if pd.api.types.is_numeric_dtype(df[column]):
+            lengths.append(8)
+            fields.append((column, ">u8"))
+        else:
+            length = max(1, int(df[column].str.len().max() or 1))
+            lengths.append(length)
+            fields.append((column, f"S{length}"))
+    records = [header("LIBRARY") + b"0" * 30 + b"  ",
+               b"SAS     SAS     SASLIB  9.1     Linux   " + b" " * 24 + stamp,
+               padded(stamp),
+               header("MEMBER") + b"000000000000000001600000000140  ",
+               header("DSCRPTR") + b"0" * 30 + b"  ",
+               b"SAS     " + f"{name.upper():<8}".encode("ascii") + b"SASDATA 9.1     Linux   " + b" " * 24 + stamp,
+               padded(stamp + b" " * 16 + b" " * 40 + b"DATA    "),
+               header("NAMESTR") + f"000000{len(df.columns):04d}".encode("ascii") + b"0" * 20 + b"  "]
+    namestrs, position = b"", 0
+    for number, (column, length) in enumerate(zip(df.columns, lengths), start=1):
+        numeric = fields[number - 1][1] == ">u8"
+        namestrs += struct.pack(">hhhh8s40s8shhh2s8shhi52s", 1 if numeric else 2, 0, length, number,
+                                f"{column:<8}".encode("ascii"), b" " * 40, b" " * 8, 0, 0, 0, b"  ",
+                                b" " * 8, 0, 0, position, b"\x00" * 52)
+        position += length
+    records.append(padded(namestrs))
+    records.append(header("OBS") + b"0" * 30 + b"  ")
+    rows = np.empty(len(df), dtype=fields)
+    for column, dtype in fields:
+        if dtype == ">u8":
+            rows[column] = ibm_float(df[column].to_numpy(dtype=np.float64))
+        else:
+            width = int(dtype[1:])
+            rows[column] = df[column].fillna("").str.ljust(width).str.encode("ascii").to_numpy(dtype=dtype)
+    with open(path, "wb") as file:
+        file.write(b"".join(records))
+        file.write(padded(rows.tobytes()))
+
+def subject_level(patients: int, rng: np.random.Generator):
+    arms = rng.choice(list(ARMS), size=patients)
+    return pd.DataFrame({
+        "STUDYID": "SYNTHETIC01",
+        "USUBJID": [f"01-{700 + site:03d}-{1000 + number}" for number, site in enumerate(rng.integers(1, 18, patients))],
+        "ARM": arms,
+        "TRT01PN": [ARMS[arm] for arm in arms],
+        "AGE": rng.integers(51, 90, patients).astype(float),
+        "SEX": rng.choice(["F", "M"], size=patients),
+        "BMIBL": np.round(rng.normal(25, 4, patients), 1)})
+
+def adverse_events(adsl: pd.DataFrame, events_per_patient: float, rng: np.random.Generator):
+    counts = rng.poisson(events_per_patient, len(adsl))
+    terms = rng.choice(list(ADVERSE_EVENTS), size=counts.sum())
+    return pd.DataFrame({
+        "STUDYID": "SYNTHETIC01",
+        "USUBJID": np.repeat(adsl["USUBJID"].to_numpy(), counts),
+        "AETERM": terms,
+        "AEDECOD": terms,
+        "AEBODSYS": [ADVERSE_EVENTS[term] for term in terms],
+        "AESEV": rng.choice(["MILD", "MODERATE", "SEVERE"], size=counts.sum(), p=[0.6, 0.3, 0.1])})
+
+def measurements(adsl: pd.DataFrame, visits: list, parameters: dict, rng: np.random.Generator,
+                 category: str = None, reference: bool = False, change: bool = True):
+    # One row per patient, visit and parameter with a change from the first visit
+    patients, codes = len(adsl), list(parameters)
+    size = patients * len(visits) * len(codes)
+    df = pd.DataFrame({
+        "STUDYID": "SYNTHETIC01",
+        "USUBJID": np.repeat(adsl["USUBJID"].to_numpy(), len(visits) * len(codes)),
+        "VISIT": np.tile(np.repeat(visits, len(codes)), patients),
+        "ADT": np.tile(np.repeat(19000.0 + 14 * np.arange(len(visits)), len(codes)), patients)
+               + np.repeat(rng.integers(0, 365, patients), len(visits) * len(codes)),
+        "PARAMCD": np.tile(codes, patients * len(visits)),
+        "PARAM": np.tile([parameters[code] for code in codes], patients * len(visits)),
+        "AVAL": np.round(rng.gamma(4.0, 10.0, size), 2)})
+    if category:
+        df["PARCAT1"] = category
+    if reference:
+        df["LBNRIND"] = rng.choice(["NORMAL", "LOW", "HIGH"], size=size, p=[0.8, 0.1, 0.1])
+    if change:
+        base = df.groupby(["USUBJID", "PARAMCD"], sort=False)["AVAL"].transform("first")
+        df["CHG"] = np.round(df["AVAL"] - base, 2)
+    return df
+
+def generate(output: str, patients: int, visits: int, events_per_patient: float, seed: int):
+    rng = np.random.default_rng(seed)
+    os.makedirs(output, exist_ok=True)
+    schedule = visit_names(visits)
+    adsl = subject_level(patients, rng)
+    datasets = {
+        "adsl": adsl,
+        "adae": adverse_events(adsl, events_per_patient, rng),
+        "adlbc": measurements(adsl, schedule, CHEMISTRY, rng, category="CHEMISTRY", reference=True),
+        "adlbh": measurements(adsl, schedule, HEMATOLOGY, rng, category="HEMATOLOGY", reference=True),
+        "advs": measurements(adsl, schedule, VITAL_SIGNS, rng),
+        "adadas": measurements(adsl, schedule[1::2], ADAS, rng),
+        "adcibc": measurements(adsl, schedule[2::2], {"CIBICVAL": "CIBIC Score"}, rng, change=False)}
+    rows = {}
+    for name, df in datasets.items():
+        write_xpt(df, os.path.join(output, f"{name}.xpt"), name)
+        rows[name] = len(df)
+        print(f"Wrote {len(df)} rows to {os.path.join(output, name)}.xpt")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes synthetic AdAM datasets as SAS XPT files")
+    parser.add_argument("--output", default="./benchmark_data")
+    parser.add_argument("--patients", type=int, default=254, help="254 matches the CDISC pilot study")
+    parser.add_argument("--visits", type=int, default=len(VISITS))
+    parser.add_argument("--adverse-events", type=float, default=4.7, help="Mean adverse events per patient")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    s = time.perf_counter()
+    rows = generate(args.output, args.patients, args.visits, args.adverse_events, args.seed)
+    elapsed = time.perf_counter() - s
+    print(f"Generated {sum(rows.values())} rows in {elapsed:0.2f} seconds.")
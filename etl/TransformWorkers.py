@@ -0,0 +1,26 @@
+import time
+from XPTcache import XptCache
+from GraphModel import payload_bytes
+
+# Worker side of the pipelined ingestion mode. Each process of the transform pool opens
+# the XPT cache once and turns row ranges of its memory-mapped Arrow files into the
+# payloads of the compiled loaders, so decoding and transforming run on every core while
+# the event loop of the pipeline only writes
+
+xpt_cache = None
+
+def init_worker(directory: str, max_bytes: int):
+    global xpt_cache
+    xpt_cache = XptCache(directory, max_bytes)
+
+def decode(path: str):
+    # Decodes the file into the cache once and returns its number of rows
+    return xpt_cache.table(path).num_rows
+
+def prepare(path: str, offset: int, rows: int, compiled, measure_bytes: bool, exact_bytes=False):
+    # Returns the payload of the rows, the seconds taken and, for the load metrics, its size as JSON
+    start = time.perf_counter()
+    df = xpt_cache.table(path).slice(offset, rows).to_pandas()
+    data = compiled.payload(df)
+    size = payload_bytes(data, exact_bytes) if measure_bytes else None
+    return data, time.perf_counter() - start, size
@@ -0,0 +1,84 @@
+import os
+import hashlib
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+class XptCache:
+    # Decodes each SAS XPT file once per content hash into an uncompressed Arrow IPC
+    # (Feather v2) file that later subflows and later runs memory-map instead of
+    # decoding the XPT again. The cache directory is bounded to max_bytes and the least
+    # recently used files are evicted first.
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3, encoding="utf-8"):
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__encoding = encoding
+        self.__hashes = {}
+        self.__tables = {}
+        self.__locks = {}
+        self.__lock = threading.Lock()
+        os.makedirs(self.__directory, exist_ok=True)
+
+    def content_hash(self, path):
+        # Hashes are memoised per path, size and modification time so a file is only read once per run
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.__hashes:
+            digest = hashlib.sha256()
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(block)
+            self.__hashes[key] = digest.hexdigest()
+        return self.__hashes[key]
+
+    def __key_lock(self, key):
+        with self.__lock:
+            return self.__locks.setdefault(key, threading.Lock())
+
+    def table(self, path):
+        # Returns the file as a memory-mapped Arrow table, decoding the XPT only on a cache miss
+        key = self.content_hash(path)
+        with self.__key_lock(key):
+            if key in self.__tables:
+                return self.__tables[key]
+            cached = os.path.join(self.__directory, f"{key}.arrow")
+            if os.path.exists(cached):
+                os.utime(cached)
+            else:
+                df = pd.read_sas(path, format='xport', encoding=self.__encoding)
+                temporary = f"{cached}.{os.getpid()}.tmp"
+                feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), temporary,
+                                      compression="uncompressed")
+                os.replace(temporary, cached)
+                self.__evict(keep=cached)
+            self.__tables[key] = feather.read_table(cached, memory_map=True)
+            return self.__tables[key]
+
+    def read(self, path):
+        return self.table(path).to_pandas()
+
+    def contains(self, path):
+        key = self.content_hash(path)
+        return key in self.__tables or os.path.exists(os.path.join(self.__directory, f"{key}.arrow"))
+
+    def batches(self, path, rows):
+        # Yields DataFrames of at most rows rows converted one record batch at a time
+        for batch in self.table(path).to_batches(max_chunksize=rows):
+            yield batch.to_pandas()
+
+    def __evict(self, keep):
+        entries = []
+        for name in os.listdir(self.__directory):
+            if name.endswith(".arrow"):
+                entry = os.path.join(self.__directory, name)
+                stat = os.stat(entry)
+                entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.__max_bytes:
+                break
+            if entry != keep:
+                os.remove(entry)
+                total -= size
@@ -2,9 +2,169 @@ import os
 import requests
 import streamlit as st
 import pandas as pd
-import json
+import tempfile
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 CHATBOT_URL = os.getenv("CHATBOT_URL")
+# Pages and exports of an answer are served next to the question endpoint
+API_URL = CHATBOT_URL.rsplit("/", 1)[0] if CHATBOT_URL else ""
+# Seconds to connect to the API and to wait for its answer. Questions wait for the LLM and the query
+CONNECT_TIMEOUT = float(os.getenv("CHATBOT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("CHATBOT_READ_TIMEOUT", "120"))
+# Answers and pages are kept for ANSWER_TTL seconds, the API answers again once the graph is reloaded
+ANSWER_TTL = int(os.getenv("ANSWER_TTL", "600"))
+# Only the latest answers show their tables on every rerun, older ones are drawn when asked for
+EXPANDED_ANSWERS = int(os.getenv("EXPANDED_ANSWERS", "3"))
+
+ERROR_MESSAGE = """An error occurred while processing your message.
+Please try again or rephrase your message."""
+
+
+@st.cache_resource
+def http_session():
+    # One pooled session per server process, so questions and pages reuse their connections.
+    # Only the idempotent page and export requests are retried
+    session = requests.Session()
+    retries = Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+    return session
+
+
+class ApiError(Exception):
+    # An answer of the API that is not a result, with the message to show
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def error_message(response: requests.Response):
+    detail = ERROR_MESSAGE
+    try:
+        detail = response.json().get("detail", detail)
+    except ValueError:
+        pass
+    # Rejected queries carry their plan cost next to the message
+    return detail.get("message", ERROR_MESSAGE) if isinstance(detail, dict) else str(detail)
+
+
+def get_json(method: str, url: str, **kwargs):
+    try:
+        response = http_session().request(method, url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+    except requests.Timeout:
+        raise ApiError("The assistant took too long to answer, please try again.")
+    except requests.ConnectionError:
+        raise ApiError("The assistant is not reachable, please try again later.")
+    if response.status_code != 200:
+        raise ApiError(error_message(response), response.status_code)
+    return response.json()
+
+
+def normalise(question: str):
+    return " ".join(question.lower().split())
+
+
+@st.cache_data(ttl=ANSWER_TTL, max_entries=256, show_spinner=False)
+def ask(question_key: str, _question: str):
+    # Answers are cached per normalised question, the question as typed is not part of the key.
+    # Errors raise and are not cached
+    return get_json("POST", CHATBOT_URL, json={'question': _question})
+
+
+@st.cache_data(ttl=ANSWER_TTL, max_entries=1024, show_spinner=False)
+def fetch_page(cursor: str):
+    return get_json("GET", f"{API_URL}/results/{cursor}")
+
+
+@st.cache_data(ttl=ANSWER_TTL, max_entries=16, show_spinner=False)
+def download_all_rows(export_cursor):
+    # Streams the full result as CSV into a temporary file instead of holding the JSON rows in memory
+    with tempfile.TemporaryFile() as file:
+        with http_session().get(f"{API_URL}/results/{export_cursor}/export", params={"format": "csv"}, stream=True,
+                                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as export:
+            export.raise_for_status()
+            for chunk in export.iter_content(chunk_size=64 * 1024):
+                file.write(chunk)
+        file.seek(0)
+        return file.read()
+
+
+def answer_message(prompt: str):
+    # The message of an answer keeps its pages as DataFrames, so reruns do not rebuild them from JSON
+    try:
+        answer = ask(normalise(prompt), prompt)
+    except ApiError as e:
+        return {"role": "assistant", "output": str(e)}
+    page = answer.get("page") or {}
+    explanation = answer.get("intermediate_steps") or [{}]
+    return {"role": "assistant", "pages": [pd.DataFrame(answer["result"])], "next_cursor": page.get("next_cursor"),
+            "export_cursor": page.get("export_cursor"), "page_size": page.get("size"), "page": 0,
+            "explanation": str(explanation[0].get("query", ""))}
+
+
+def turn_page(message: dict, step: int):
+    # Button callbacks run before the fragment, so the table drawn is already the new page.
+    # Pages are fetched from the API when first shown and kept in the message
+    message.pop("error", None)
+    if step > 0 and message["page"] + 1 == len(message["pages"]):
+        try:
+            page = fetch_page(message["next_cursor"])
+        except ApiError as e:
+            message["error"] = str(e)
+            # Cursors of a reloaded graph are gone, the question has to be answered again
+            if e.status_code == 410:
+                ask.clear()
+            return
+        message["pages"].append(pd.DataFrame(page["result"]))
+        message["next_cursor"] = page["next_cursor"]
+    message["page"] += step
+
+
+def export_rows(message: dict):
+    message["csv"] = True
+
+
+@st.experimental_fragment
+def render_table(message: dict, key: str):
+    # Runs on its own when its buttons are pressed, without rerunning the chat history
+    index = message["page"]
+    df = message["pages"][index]
+    st.dataframe(df, use_container_width=True, hide_index=True)
+    more = index + 1 < len(message["pages"]) or message["next_cursor"]
+    if index or more:
+        first = index * (message["page_size"] or len(df)) + 1
+        st.caption(f"Page {index + 1}, rows {first} to {first + len(df) - 1}")
+        previous, following, _ = st.columns([1, 1, 4])
+        previous.button("Previous", key=f"{key}-previous", disabled=index == 0, on_click=turn_page, args=(message, -1))
+        following.button("Next", key=f"{key}-next", disabled=not more, on_click=turn_page, args=(message, 1))
+    if "error" in message:
+        st.error(message["error"])
+    # The CSV is only built when asked for. Answers with more pages export every row from the API
+    if not message.get("csv"):
+        st.button("Prepare CSV", key=f"{key}-csv", on_click=export_rows, args=(message,))
+        return
+    try:
+        with st.spinner("Exporting all rows..."):
+            if message["next_cursor"] or len(message["pages"]) > 1:
+                csv_data = download_all_rows(message["export_cursor"])
+            else:
+                csv_data = df.to_csv(index=False).encode('utf-8')
+    except requests.RequestException as e:
+        st.error(f"The export failed: {e}")
+        return
+    st.download_button("Press to Download", csv_data, "file.csv", "text/csv", key=f"{key}-download")
+
+
+def render_message(message: dict, key: str, expanded: bool):
+    if "pages" not in message:
+        st.markdown(message["output"])
+        return
+    # Older answers only draw their table when it is shown again
+    if expanded or st.toggle("Show table", key=f"{key}-show"):
+        render_table(message, key)
+    st.status("Cypher query produced:", state="complete").code(message["explanation"])
+
 
 with st.sidebar:
     st.header("About")
@@ -42,46 +202,18 @@ st.image('AdamGraph.png', caption='Clinical trial graph model')
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-for message in st.session_state.messages:
+answers = [index for index, message in enumerate(st.session_state.messages) if message["role"] == "assistant"]
+recent = set(answers[-EXPANDED_ANSWERS:])
+for index, message in enumerate(st.session_state.messages):
     with st.chat_message(message["role"]):
-        if "output" in message.keys():
-            st.markdown(message["output"])
-
-        # if "explanation" in message.keys():
-        #     with st.status("How was this generated", state="complete"):
-        #         st.info(message["explanation"])
+        render_message(message, f"message-{index}", index in recent)
 
 if prompt := st.chat_input("What do you want to know?"):
     st.chat_message("user").markdown(prompt)
-
     st.session_state.messages.append({"role": "user", "output": prompt})
 
-    data = {'question': prompt}
     with st.spinner("Querying the database..."):
-        response = requests.post(url=CHATBOT_URL, json=data)
-        if response.status_code == 200:
-            cypher_table = response.json()["result"]
-            explanation = response.json()["intermediate_steps"]
-            cypher_query = str(explanation[0]['query'])
-
-        else:
-            cypher_table = """An error occurred while processing your message.
-            Please try again or rephrase your message."""
-            explanation = cypher_table
-    
-    df = pd.DataFrame(cypher_table)
-    st.chat_message("assistant").table(df)
-    st.download_button(
-   "Press to Download",
-   df.to_csv(index=False).encode('utf-8'),
-   "file.csv",
-   "text/csv",
-   key='download-csv'
-)
-    st.status("Cypher query produced:", state="complete").code(cypher_query)
-    st.session_state.messages.append(
-        {   "role": "assistant",
-            "output": cypher_table,
-            "explanation": cypher_query,
-        }
-    )
\ No newline at end of file
+        message = answer_message(prompt)
+    st.session_state.messages.append(message)
+    with st.chat_message("assistant"):
+        render_message(message, f"message-{len(st.session_state.messages) - 1}", True)
@@ -0,0 +1,130 @@
+import asyncio
+import functools
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Overloaded(Exception):
+    # Raised when a question cannot be admitted. status_code is 429 when the waiting queue
+    # is full and 503 when no worker became free within the queue timeout
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class QuestionGate:
+    # Runs the blocking chain and graph calls of each question on a bounded thread pool so
+    # the event loop keeps serving requests. At most workers questions run at once and
+    # at most max_queue wait for a worker. Identical questions in flight are coalesced
+    # into one run whose answer is shared by all of them. Exports hold a worker slot for as
+    # long as their rows are read, without the request timeout.
+
+    def __init__(self, workers=4, max_queue=16, queue_timeout=10.0, request_timeout=90.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.stats = {"admitted": 0, "coalesced": 0, "rejected": 0, "queue_timeouts": 0, "request_timeouts": 0}
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cypher-qa")
+        self.__slots = None
+        self.__waiting = 0
+        self.__running = 0
+        self.__in_flight = {}
+
+    async def __acquire(self):
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.workers)
+        if self.__slots.locked():
+            self.__waiting += 1
+            try:
+                await asyncio.wait_for(self.__slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["queue_timeouts"] += 1
+                raise Overloaded(503, "All workers are busy, try again later", int(self.queue_timeout))
+            finally:
+                self.__waiting -= 1
+        else:
+            await self.__slots.acquire()
+        self.__running += 1
+
+    def __release(self, _=None):
+        self.__running -= 1
+        self.__slots.release()
+
+    async def __execute(self, function, *args):
+        await self.__acquire()
+        future = asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(function, *args))
+        # The worker slot is only given back when the thread is done, even after a timeout
+        future.add_done_callback(self.__release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.request_timeout)
+        except asyncio.TimeoutError:
+            self.stats["request_timeouts"] += 1
+            raise
+
+    async def run(self, key, function, *args):
+        if key in self.__in_flight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.__in_flight[key])
+        if self.__waiting >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise Overloaded(429, "Too many questions waiting, try again later", 1)
+        self.stats["admitted"] += 1
+        shared = asyncio.get_running_loop().create_future()
+        self.__in_flight[key] = shared
+        try:
+            result = await self.__execute(function, *args)
+            shared.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            shared.cancel()
+            raise
+        except Exception as e:
+            shared.set_exception(e)
+            # Marks the exception as retrieved when no other request was waiting for it
+            shared.exception()
+            raise
+        finally:
+            del self.__in_flight[key]
+
+    async def stream(self, iterator, batch_size=256):
+        # Admits the iterator of a blocking export like a question and returns an async
+        # iterator over its items, read batch_size at a time on the pool. Raises Overloaded
+        # when it cannot be admitted
+        if self.__waiting >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise Overloaded(429, "Too many questions waiting, try again later", 1)
+        await self.__acquire()
+        self.stats["admitted"] += 1
+        return self.__iterate(iterator, batch_size)
+
+    async def __iterate(self, iterator, batch_size):
+        loop = asyncio.get_running_loop()
+        pending = None
+        try:
+            while True:
+                pending = loop.run_in_executor(self.__executor, list, islice(iterator, batch_size))
+                batch = await asyncio.shield(pending)
+                if not batch:
+                    return
+                for item in batch:
+                    yield item
+        finally:
+            # The iterator is closed and the slot given back once the batch being read is done,
+            # also when the client went away in the middle of the export
+            def close(_):
+                loop.run_in_executor(self.__executor, iterator.close).add_done_callback(self.__release)
+
+            if pending is None or pending.done():
+                close(pending)
+            else:
+                pending.add_done_callback(close)
+
+    def summary(self):
+        return {**self.stats, "workers": self.workers, "running": self.__running, "waiting": self.__waiting,
+                "max_queue": self.max_queue, "in_flight_questions": len(self.__in_flight)}
+
+    def close(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
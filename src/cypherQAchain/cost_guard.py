@@ -0,0 +1,117 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from neo4j import Query
+from cypherQAchain.result_cache import STRING_LITERAL, normalise_cypher
+
+# Variable length relationships without an upper bound, as in [*], [r*2..] or [:TYPE*]
+UNBOUNDED_EXPAND = re.compile(r"\*\s*(?:(\d*)\s*\.\.)?\s*(?=[\]{])")
+FINAL_LIMIT = re.compile(r"\bLIMIT\s+(\d+|\$\w+)\s*$", re.IGNORECASE)
+UNION = re.compile(r"\bUNION\b", re.IGNORECASE)
+
+
+class CostRejected(ValueError):
+    # Raised when the plan of a generated statement is over the budget of the guard
+    def __init__(self, detail, cost):
+        super().__init__(detail)
+        self.detail = detail
+        self.cost = cost
+
+
+def plan_operators(plan: dict):
+    # Flattens the operator tree of an EXPLAIN into (operator, estimated rows) pairs
+    operators = [(plan["operatorType"].split("@")[0], plan.get("args", plan.get("arguments", {})).get("EstimatedRows", 0.0))]
+    for child in plan.get("children", []):
+        operators.extend(plan_operators(child))
+    return operators
+
+
+class CostGuard:
+    # Checks generated Cypher before it runs. Unbounded variable length relationships are
+    # bounded to max_hops and statements without a final LIMIT get one of max_rows. The
+    # rewritten statement is then planned with EXPLAIN, which does not run it, and is
+    # rejected when the plan has a forbidden operator or an operator estimated to produce
+    # more than max_estimated_rows rows. Decisions are kept per statement and graph version.
+    # Exports and write statements are planned without the row cap, as their rows are not
+    # meant to be cut off, but keep the operator and expand checks.
+
+    def __init__(self, max_estimated_rows=5_000_000, forbidden_operators=("CartesianProduct", "AllNodesScan"),
+                 max_hops=4, max_rows=100_000, max_entries=1000):
+        self.max_estimated_rows = max_estimated_rows
+        self.forbidden_operators = tuple(forbidden_operators)
+        self.max_hops = max_hops
+        self.max_rows = max_rows
+        self.max_entries = max_entries
+        self.stats = {"checked": 0, "rewritten": 0, "rejected": 0, "planning_ms": 0.0}
+        self.__decisions = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def rewrite(self, cypher: str, cap_rows=True):
+        # Returns the bounded statement and the list of rewrites applied to it
+        def bound(match):
+            lower = int(match.group(1) or 1)
+            return f"*{lower}..{max(lower, self.max_hops)}"
+
+        rewrites = []
+        # Literals are at the odd positions and never rewritten
+        parts = STRING_LITERAL.split(cypher.strip().rstrip(";"))
+        for index in range(0, len(parts), 2):
+            parts[index], count = UNBOUNDED_EXPAND.subn(bound, parts[index])
+            if count and "max_hops" not in rewrites:
+                rewrites.append("max_hops")
+        cypher = "".join(parts)
+        # A LIMIT after a UNION only applies to its last query
+        if cap_rows and self.max_rows and not any(UNION.search(part) for part in parts[::2]) and not FINAL_LIMIT.search(parts[-1]):
+            cypher += f"\nLIMIT {self.max_rows}"
+            rewrites.append("limit")
+        return cypher, rewrites
+
+    def explain(self, graph, cypher: str, params=None):
+        with graph._driver.session(database=graph._database) as session:
+            return session.run(Query(f"EXPLAIN {cypher}"), params or {}).consume().plan
+
+    def check(self, graph, cypher: str, version, params=None, cap_rows=True):
+        # Returns the decision for the statement, the rewritten Cypher under "cypher", or
+        # raises CostRejected with the plan cost. Parameterised statements share their
+        # decision whatever the values of their parameters
+        key = (normalise_cypher(cypher), version, cap_rows)
+        with self.__lock:
+            if key in self.__decisions:
+                self.__decisions.move_to_end(key)
+                decision = self.__decisions[key]
+                if decision["rejected"]:
+                    raise CostRejected(decision["rejected"], decision["cost"])
+                return decision
+        guarded, rewrites = self.rewrite(cypher, cap_rows)
+        s = time.perf_counter()
+        operators = plan_operators(self.explain(graph, guarded, params))
+        cost = {"estimated_rows": round(operators[0][1]), "max_operator_rows": round(max(rows for _, rows in operators)),
+                "operators": sorted({operator for operator, _ in operators}), "rewrites": rewrites,
+                "explain_ms": round((time.perf_counter() - s) * 1000, 1)}
+        forbidden = [operator for operator in cost["operators"] if operator in self.forbidden_operators]
+        rejected = None
+        if forbidden:
+            rejected = f"The generated query was rejected because its plan has {', '.join(forbidden)}"
+        elif cost["max_operator_rows"] > self.max_estimated_rows:
+            rejected = (f"The generated query was rejected because it is estimated to read {cost['max_operator_rows']} rows, "
+                        f"over the budget of {self.max_estimated_rows}")
+        decision = {"cypher": guarded, "cost": cost, "rejected": rejected}
+        with self.__lock:
+            self.stats["checked"] += 1
+            self.stats["planning_ms"] += cost["explain_ms"]
+            if rejected:
+                self.stats["rejected"] += 1
+            elif rewrites:
+                self.stats["rewritten"] += 1
+            self.__decisions[key] = decision
+            while len(self.__decisions) > self.max_entries:
+                self.__decisions.popitem(last=False)
+        if rejected:
+            raise CostRejected(rejected, cost)
+        return decision
+
+    def summary(self):
+        with self.__lock:
+            return {**self.stats, "max_estimated_rows": self.max_estimated_rows, "forbidden_operators": list(self.forbidden_operators),
+                    "max_hops": self.max_hops, "max_rows": self.max_rows}
@@ -0,0 +1,31 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+
+class CursorCodec:
+    # Page cursors are the Cypher statement, the graph version it was answered on and the
+    # first row of the page, signed so that clients cannot send arbitrary Cypher through
+    # them. Without a secret the cursors are only valid until the service restarts.
+
+    def __init__(self, secret=None):
+        self.__secret = secret.encode() if secret else os.urandom(32)
+
+    def __signature(self, payload: bytes):
+        return hmac.new(self.__secret, payload, hashlib.sha256).digest()
+
+    def encode(self, cypher: str, version, skip: int):
+        payload = json.dumps({"cypher": cypher, "version": version, "skip": skip}, separators=(",", ":")).encode()
+        return (base64.urlsafe_b64encode(payload).decode().rstrip("=") + "."
+                + base64.urlsafe_b64encode(self.__signature(payload)).decode().rstrip("="))
+
+    def decode(self, token: str):
+        try:
+            payload, signature = (base64.urlsafe_b64decode(part + "=" * (-len(part) % 4)) for part in token.split("."))
+        except ValueError:
+            raise ValueError("Malformed cursor")
+        if not hmac.compare_digest(signature, self.__signature(payload)):
+            raise ValueError("Invalid cursor")
+        return json.loads(payload)
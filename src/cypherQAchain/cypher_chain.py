@@ -1,134 +1,305 @@
-import json
+import threading
+import time
 from langchain_openai import ChatOpenAI
 from langchain.prompts import (
     PromptTemplate,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
     ChatPromptTemplate,
+    MessagesPlaceholder,
 )
 from langchain.chains import GraphCypherQAChain
+from langchain.chains.graph_qa.cypher import construct_schema
 from langchain_community.graphs import Neo4jGraph
-from dotenv import dotenv_values
+from cypherQAchain.result_cache import ResultCache, CachedGraph
+from cypherQAchain.cost_guard import CostGuard
+from cypherQAchain.parameters import parameterise
+from cypherQAchain.example_store import ExampleStore
+from cypherQAchain.question_cache import normalise_question
+import tiktoken
 import os
 
+system_prompt_template = """Task:Generate Cypher statement to query a graph database that represents a clinical trial.
+Instructions:
+Use only the provided relationship types and properties in the schema.
+Check the schema before building your query to make sure you filter the right property of the corresponding node.
+Temperature,Weight, Blood Pressure, Height and Pulse Rate are VitalSign nodes, not hematology nor chemistry parameter nodes.
+Do not use any other relationship types or properties that are not provided.
+Do not use MATCH clause when filtering text node properties.
+Use the WHERE clause together with the CONATINS clause to filter text node properties even when filtering multiple properties
+Always write the label of the nodes you filter, as in (pa:Parameter), (ae:AdverseEvent), (v:Visit) or (end:Endpoint), so the filters use the indexes of the graph.
+Filter numeric properties such as Value with comparison operators on the property itself.
+If the user requests a table or output in tablular format, return an array of objects for each record.
+Make sure that node properties are capitalized or not capitalized accordingly.
+Do not use variable names to filter on numeric properties.
+Make sure to capitalize the first letter of each node property word.
+Schema:
+{schema}
+Note: Do not include any explanations or apologies in your responses.
+Do not respond to any questions that might ask anything else than for you to construct a Cypher statement.
+Do not include any text except the generated Cypher statement.
+Examples of generated Cypher statements for specific questions:
+{examples}
+"""
 
-async def graph_chain(Question: str):
-    graph = Neo4jGraph(
-    url=os.getenv('NEO4J_URI'), 
-                       username=os.getenv('NEO4J_USER'),              
-                       password=os.getenv('NEO4J_PASSWORD')
+# Instructions for the summary projections built by the ETL pipeline, added to the schema
+# when it shows them
+projection_prompt = """
+Summary projections:
+ParameterSummary nodes hold the Count, Patients, Mean, Min, Max and StdDev of the measurements of each Parameter per Treatment and Visit.
+AdverseEventSummary nodes hold, for each BodySystem per Treatment, the Patients with adverse events, PatientTerms, the number of distinct patient and adverse event term pairs, and PatientTermsLastSevere, the number of those pairs whose last recorded severity is SEVERE. They do not count individual occurrences of adverse events.
+LATEST_MEASUREMENT relationships link each Patient to its most recent measurement of each parameter.
+Use the summary projections for averages, counts, minimums and maximums per treatment group, visit or body system instead of aggregating the measurements.
+"""
+
+PROJECTION_TYPES = {"ParameterSummary", "AdverseEventSummary", "LATEST_MEASUREMENT"}
+
+# Instructions for the compact graph layout, added to the schema when it has ParameterDefinition nodes
+compact_layout_prompt = """
+Compact layout:
+Parameter and Endpoint measurement nodes only hold their Value, Date and Reference.
+The Parameter name, Code, Laboratory, Dataset and EndpointName of a measurement are on the ParameterDefinition node it links to with OF_PARAMETER.
+The patient and visit of a measurement are the Patient and Visit nodes linked to it, filter them on the Patient USUBJID and the Visit Name.
+"""
+
+system_prompt = SystemMessagePromptTemplate(
+    prompt=PromptTemplate(
+        input_variables=["schema", "examples"],
+        template=system_prompt_template,
+    )
 )
-    system_prompt_template = """Task:Generate Cypher statement to query a graph database that represents a clinical trial.
-    Instructions:
-    Use only the provided relationship types and properties in the schema.
-    Check the schema before building your query to make sure you filter the right property of the corresponding node.
-    Temperature,Weight, Blood Pressure, Height and Pulse Rate are VitalSign nodes, not hematology nor chemistry parameter nodes.
-    Do not use any other relationship types or properties that are not provided.
-    Do not use MATCH clause when filtering text node properties.
-    Use the WHERE clause together with the CONATINS clause to filter text node properties even when filtering multiple properties
-    If the user requests a table or output in tablular format, return an array of objects for each record.
-    Make sure that node properties are capitalized or not capitalized accordingly.
-    Do not use variable names to filter on numeric properties.
-    Make sure to capitalize the first letter of each node property word.
-    Schema:
-    {schema}
-    Note: Do not include any explanations or apologies in your responses.
-    Do not respond to any questions that might ask anything else than for you to construct a Cypher statement.
-    Do not include any text except the generated Cypher statement.
-    Examples of generated Cypher statements for specific questions:
-    # How many patients does the study contain?
-    MATCH (p:Patient)
-    RETURN count(p) AS numberOfPatients
-    # How many patients experienced an adverse event?
-    MATCH (p:Patient)-[:EXPERIENCED_ADVERSE_EVENT]-(ae:AdverseEvent)
-    RETURN COUNT(DISTINCT p.USUBJID)
-    # How many patients have been assessed on the ADAS endpoint?
-    MATCH (p:Patient)-[:ASSESSED_ENDPOINT]-(end:Endpoint)
-    WHERE end.EndpointName CONTAINS 'ADAS'
-    RETURN COUNT(DISTINCT p.USUBJID)
-    # How many patients have been assessed on the CIBC endpoint?
-    MATCH (p:Patient)-[:ASSESSED_ENDPOINT]-(end:Endpoint)
-    WHERE end.EndpointName CONTAINS 'CIBC'
-    RETURN COUNT(DISTINCT p.USUBJID)
-    # Give me the hematology laboratory parameters and their values for the Patient with unique identifier 01-701-1192
-    MATCH (p:Patient {{USUBJID: '01-701-1192'}})-[:MEASURED_LABPARAMETER]-(pa:Parameter:Hematology)
-    RETURN pa.Parameter, pa.Value
-    # Give me the chemistry laboratory parameters and their values for the Patient with unique identifier 01-701-1192
-    MATCH (p:Patient {{USUBJID: '01-701-1192'}})-[:MEASURED_LABPARAMETER]-(pa:Parameter:Chemistry)
-    RETURN pa.Parameter, pa.Value
-    # What endpoints are evaluated in the clinical trial?
-    MATCH (end:Endpoint)
-    RETURN DISTINCT end.EndpointName
-    # What patient had the highest hemoglobin value
-    MATCH (p:Patient)-[:MEASURED_LABPARAMETER]-(pa:Parameter)
-    WHERE pa.Parameter CONTAINS 'Hemoglobin'
-    RETURN p.USUBJID, pa.Value
-    ORDER BY pa.Value DESC
-    LIMIT 1
-    # What is the treatment group with more patients experiencing a cariac adverse event?
-    MATCH (t:Treatment)<-[:WAS_TREATED]-(p:Patient)-[:EXPERIENCED_ADVERSE_EVENT]->(ae:AdverseEvent)
-    WHERE ae.Term CONTAINS 'CARDIAC'
-    WITH t, COUNT(DISTINCT p.USUBJID) AS numPatients
-    RETURN t.Name AS TreatmentGroup, numPatients
-    ORDER BY numPatients DESC
-    LIMIT 1
-    # I need the average albumin levels of the patients in each treatment group in the screeining visit
-    MATCH (t:Treatment)<-[:WAS_TREATED]-(p:Patient)-[:MEASURED_LABPARAMETER]-(pa:Parameter)-[:MEASURED_IN_VISIT]-(vis:Visit)
-    WHERE pa.Parameter CONTAINS 'Albumin' AND vis.Name CONTAINS 'SCREENING'
-    RETURN t.Name AS TreatmentGroup, AVG(pa.Value) AS AverageAlbuminLevels
-    # Give me a table with the hemoglobin measurements of the patients in each visit
-    MATCH (p:Patient)-[:MEASURED_LABPARAMETER]-(pa:Parameter:Hematology)<-[:MEASURED_IN_VISIT]-(v:Visit)
-    WHERE pa.Parameter CONTAINS 'Hemoglobin'
-    RETURN p.USUBJID, v.Name, pa.Value, pa.Parameter
-    # Give me a table with the hemoglobin measurements of the patients for visit at 2 weeks
-    MATCH (p:Patient)-[:MEASURED_LABPARAMETER]-(pa:Parameter)<-[:MEASURED_IN_VISIT]-(v:Visit)
-    WHERE pa.Parameter CONTAINS 'Hemoglobin' AND v.Name='WEEK 2'
-    RETURN p.USUBJID, v.Name, pa.Value, pa.Parameter
-    # Give me a table with monocytes counts for all patients in visit at 4 weeks and their treatment group
-    MATCH (p:Patient)-[:MEASURED_LABPARAMETER]-(pa:Parameter:Hematology)-[:MEASURED_IN_VISIT]-(v:Visit)
-    MATCH (p)-[:WAS_TREATED]->(t:Treatment)
-    WHERE pa.Parameter CONTAINS 'Monocytes' AND v.Name CONTAINS 'WEEK 4'
-    RETURN p.USUBJID, t.Name AS TreatmentGroup, pa.Value, pa.Parameter
-    # I need the sodium levels for each patients in each visit in tabular format
-    MATCH (p:Patient)-[:MEASURED_LABPARAMETER]-(pa:Parameter)<-[:MEASURED_IN_VISIT]-(v:Visit)
-    WHERE pa.Parameter CONTAINS 'Sodium'
-    RETURN p.USUBJID, v.Name, pa.Value, pa.Parameter
-    # What are the blood pressures of each patient and their treatment in the screening visit?
-    MATCH (t:Treatment)-[:WAS_TREATED]-(p:Patient)-[:MEASURED_VITALSIGN]-(vs:VitalSign)<-[:MEASURED_IN_VISIT]-(v:Visit)
-    WHERE vs.Parameter CONTAINS 'Blood Pressure'
-    RETURN p.USUBJID,t.Name, v.Name, vs.Value, vs.Parameter
-    """
-
-    system_prompt = SystemMessagePromptTemplate(
-        prompt=PromptTemplate(
-            input_variables=["schema"],
-            template=system_prompt_template,
-        )
+
+human_prompt = HumanMessagePromptTemplate(
+    prompt=PromptTemplate(
+        input_variables=["question"],
+        template="{question}",
     )
+)
+messages = [system_prompt, human_prompt]
+
+full_prompt_template = ChatPromptTemplate(
+    input_variables=["schema", "examples", "question"],
+    messages=messages,
+)
+
+# The prompt of each question is built by the service, so the chain sends its messages as they are
+cypher_prompt = ChatPromptTemplate.from_messages([MessagesPlaceholder(variable_name="question")])
+
+def format_examples(examples: list):
+    return "\n".join(f"# {example['question']}\n{example['cypher'].strip()}" for example in examples)
+
+# The ETL pipeline stamps every successful load on a GraphVersion node, which is not part
+# of the clinical trial schema shown to the LLM
+VERSION_LABEL = "GraphVersion"
+
+def graph_version(graph: Neo4jGraph):
+    records = graph.query(f"MATCH (v:{VERSION_LABEL}) RETURN max(v.version) AS version")
+    return records[0]["version"] if records else None
+
+
+class CypherChainService:
+    # Builds the graph client, the LLM client and the GraphCypherQAChain once per process.
+    # The schema is introspected once and refreshed when it is older than schema_ttl
+    # seconds, when refresh_schema is called or when the graph version stamp changes. The
+    # stamp is read at most once every version_check_interval seconds. The chain queries
+    # the graph through the result cache, keyed by the same stamp. llm_timeout bounds each
+    # call to the LLM and cypher_timeout each transaction in Neo4j. Answers hold the first
+    # page_size rows of the result. Generated Cypher is checked by the cost guard, if
+    # any, before it runs. The prompt of each question only holds the examples_k examples
+    # most similar to it and the part of the schema those examples and the question name.
+
+    def __init__(self, schema_ttl=3600.0, version_check_interval=30.0, result_cache=None, llm_timeout=None,
+                 cypher_timeout=None, page_size=100, guard=None, examples=None, examples_k=4):
+        self.schema_ttl = schema_ttl
+        self.version_check_interval = version_check_interval
+        self.llm_timeout = llm_timeout
+        self.cypher_timeout = cypher_timeout
+        self.page_size = page_size
+        self.guard = guard
+        self.examples = examples or ExampleStore()
+        self.examples_k = examples_k
+        self.result_cache = result_cache or ResultCache()
+        self.graph = None
+        self.cached_graph = None
+        self.llm = None
+        self.qa_chain = None
+        self.schema = None
+        self.structured_schema = None
+        self.types = set()
+        self.encoding = None
+        self.full_prompt_tokens = None
+        self.prompt_stats = {"questions": 0, "tokens": 0}
+        self.version = None
+        self.refreshed_at = 0.0
+        self.checked_at = 0.0
+        self.__lock = threading.Lock()
+        # Questions are answered on several worker threads
+        self.__stats_lock = threading.Lock()
+
+    def start(self):
+        # Opens the connections and introspects the schema so the first question does not pay for it
+        with self.__lock:
+            if self.qa_chain is None:
+                if self.graph is None:
+                    self.graph = Neo4jGraph(url=os.getenv('NEO4J_URI'),
+                                            username=os.getenv('NEO4J_USER'),
+                                            password=os.getenv('NEO4J_PASSWORD'),
+                                            timeout=self.cypher_timeout,
+                                            refresh_schema=False)
+                    self.cached_graph = CachedGraph(self.graph, self.result_cache, lambda: self.version,
+                                                    page_size=self.page_size, timeout=self.cypher_timeout,
+                                                    guard=self.guard)
+                    self.llm = ChatOpenAI(model="gpt-3.5-turbo-0125",temperature=0, openai_api_key=os.getenv('OPENAI_API_KEY'),
+                                          request_timeout=self.llm_timeout)
+                    try:
+                        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+                    except Exception as e:
+                        print("Prompt tokens are estimated from their length, the tokenizer is not available:", e)
+                self.__refresh()
 
-    human_prompt = HumanMessagePromptTemplate(
-        prompt=PromptTemplate(
-            input_variables=["question"],
-            template="{question}",
+    @property
+    def ready(self):
+        return self.qa_chain is not None
+
+    def close(self):
+        if self.graph is not None:
+            self.graph._driver.close()
+
+    def count_tokens(self, messages: list):
+        # Tokens of the chat messages as counted by OpenAI, with 4 tokens per message and 3 for the reply
+        if self.encoding is None:
+            return sum(len(message.content) // 4 + 4 for message in messages) + 3
+        return sum(len(self.encoding.encode(message.content)) + 4 for message in messages) + 3
+
+    def schema_text(self, types):
+        # Schema restricted to the labels and relationship types in types, or the whole schema
+        schema = construct_schema(self.structured_schema, sorted(types), [VERSION_LABEL])
+        if types & PROJECTION_TYPES or not types and self.types & PROJECTION_TYPES:
+            schema += projection_prompt
+        if "ParameterDefinition" in (types or self.types):
+            schema += compact_layout_prompt
+        return schema
+
+    def prompt(self, question: str):
+        # Returns the messages for the question and how they were built
+        examples = self.examples.select(question, self.examples_k, self.types)
+        # Labels named in the question, such as treatment or visit, are added to the ones of the examples
+        squashed = normalise_question(question).replace(" ", "")
+        types = {name for name in self.types if name.lower() in squashed}
+        for example in examples:
+            types |= example["types"] & self.types
+        messages = full_prompt_template.format_messages(schema=self.schema_text(types), examples=format_examples(examples),
+                                                        question=question)
+        return messages, {"tokens": self.count_tokens(messages), "full_prompt_tokens": self.full_prompt_tokens,
+                          "examples": [{"question": example["question"], "similarity": example["similarity"]} for example in examples],
+                          "schema_types": sorted(types)}
+
+    def __refresh(self):
+        self.graph.refresh_schema()
+        self.structured_schema = self.graph.get_structured_schema
+        self.types = ({label for label in self.structured_schema.get("node_props", {})}
+                      | {relationship["type"] for relationship in self.structured_schema.get("relationships", [])}) - {VERSION_LABEL}
+        self.schema = self.schema_text(set())
+        # Size of the prompt with every example and the whole schema, to compare with the selected ones
+        self.full_prompt_tokens = self.count_tokens(full_prompt_template.format_messages(
+            schema=self.schema, examples=format_examples(self.examples.select("", len(self.examples.examples), self.types)),
+            question=""))
+        self.version = graph_version(self.graph)
+        # The chain keeps the schema it was built with for the Cypher validation, so it is rebuilt with it
+        self.qa_chain = GraphCypherQAChain.from_llm(
+            self.llm,
+            graph=self.cached_graph,
+            verbose=True,
+            return_direct=True,
+            return_intermediate_steps=True,
+            cypher_prompt=cypher_prompt,
+            validate_cypher=True,
+            exclude_types=[VERSION_LABEL],
+            top_k=self.page_size,
         )
-    )
-    messages = [system_prompt, human_prompt]
+        self.refreshed_at = self.checked_at = time.monotonic()
 
-    full_prompt_template = ChatPromptTemplate(
-        input_variables=["schema", "question"],
-        messages=messages,
-    )
+    def refresh_schema(self):
+        self.start()
+        with self.__lock:
+            self.__refresh()
+        return self.status()
+
+    def current_schema(self):
+        # Returns the cached schema, refreshing it first when it expired or the graph was reloaded
+        self.start()
+        now = time.monotonic()
+        with self.__lock:
+            if now - self.refreshed_at > self.schema_ttl:
+                self.__refresh()
+            elif now - self.checked_at > self.version_check_interval:
+                self.checked_at = now
+                if graph_version(self.graph) != self.version:
+                    self.__refresh()
+            return self.schema, self.qa_chain
+
+    def status(self):
+        with self.__stats_lock:
+            questions, tokens = self.prompt_stats["questions"], self.prompt_stats["tokens"]
+        return {"graph_version": self.version, "schema_age_seconds": round(time.monotonic() - self.refreshed_at, 1),
+                "schema_ttl_seconds": self.schema_ttl, "full_prompt_tokens": self.full_prompt_tokens,
+                "mean_prompt_tokens": round(tokens / questions, 1) if questions else None}
+
+    def ask(self, question: str):
+        _, chain = self.current_schema()
+        messages, prompt = self.prompt(question)
+        with self.__stats_lock:
+            self.prompt_stats["questions"] += 1
+            self.prompt_stats["tokens"] += prompt["tokens"]
+        print(f"Prompt of {prompt['tokens']} tokens ({self.full_prompt_tokens} with every example and the whole schema)")
+        response = chain.invoke({"query": messages})
+        response["query"] = question
+        response["prompt"] = prompt
+        return response
+
+    def run_cypher(self, question: str, cypher: str):
+        # Answers with Cypher generated earlier, without calling the LLM. The rows are
+        # limited and returned in the same shape as the chain does
+        self.current_schema()
+        rows = self.cached_graph.query(cypher)[: self.qa_chain.top_k]
+        return {"query": question, "result": rows, "intermediate_steps": [{"query": cypher}]}
+
+    def page(self, cypher: str, skip: int, limit: int):
+        # Returns limit rows starting at row skip and whether more rows follow
+        self.current_schema()
+        rows = self.cached_graph.page(cypher, skip, limit + 1)
+        return rows[:limit], len(rows) > limit
+
+    def stream(self, cypher: str):
+        # Generator of every row of the result, the cost guard does not cap the rows of
+        # exports. Nothing runs until the first row is read, so the service is started on
+        # the thread reading the rows and never on the event loop
+        self.start()
+        yield from self.cached_graph.stream(cypher, cap_rows=False)
+
+    def plan_cost(self, cypher: str, cap_rows=True):
+        # Estimated cost of the plan of the statement and the rewrites applied to it, or
+        # None without a cost guard. Raises CostRejected when it is over budget
+        if self.guard is None:
+            return None
+        self.current_schema()
+        text, params = parameterise(cypher)
+        return self.guard.check(self.graph, text, self.version, params, cap_rows)["cost"]
+
+
+def generated_cypher(response: dict):
+    return response["intermediate_steps"][0]["query"]
 
-    cypherChain = GraphCypherQAChain.from_llm(
-        ChatOpenAI(model="gpt-3.5-turbo-0125",temperature=0, openai_api_key=os.getenv('OPENAI_API_KEY')),
-        graph=graph,
-        verbose=True,
-        return_direct=True,
-        return_intermediate_steps=True,
-        cypher_prompt=full_prompt_template,
-        validate_cypher=True,
-    )
 
-    cypher_chain = full_prompt_template | cypherChain
-    response = cypher_chain.invoke({"schema":graph.schema,"question": Question})
-    return response
\ No newline at end of file
+service = CypherChainService(schema_ttl=float(os.getenv('SCHEMA_TTL_SECONDS', 3600)),
+                             version_check_interval=float(os.getenv('GRAPH_VERSION_CHECK_SECONDS', 30)),
+                             result_cache=ResultCache(max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 ** 2))),
+                             llm_timeout=float(os.getenv('LLM_TIMEOUT_SECONDS', 30)),
+                             cypher_timeout=float(os.getenv('CYPHER_TIMEOUT_SECONDS', 30)),
+                             page_size=int(os.getenv('PAGE_SIZE', 100)),
+                             guard=CostGuard(max_estimated_rows=float(os.getenv('COST_MAX_ESTIMATED_ROWS', 5_000_000)),
+                                             forbidden_operators=os.getenv('COST_FORBIDDEN_OPERATORS', 'CartesianProduct,AllNodesScan').split(','),
+                                             max_hops=int(os.getenv('COST_MAX_HOPS', 4)),
+                                             max_rows=int(os.getenv('MAX_RESULT_ROWS', 100_000)))
+                             if os.getenv('COST_GUARD_ENABLED', 'true').lower() == 'true' else None,
+                             examples_k=int(os.getenv('EXAMPLES_TOP_K', 4)))
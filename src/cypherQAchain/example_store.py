@@ -0,0 +1,89 @@
+import hashlib
+import json
+import math
+import os
+import re
+import yaml
+from collections import Counter
+from cypherQAchain.question_cache import normalise_question, question_terms
+from cypherQAchain.result_cache import STRING_LITERAL
+
+EXAMPLES_PATH = os.path.join(os.path.dirname(__file__), "examples.yaml")
+INDEX_PATH = os.path.join(os.path.dirname(__file__), "examples_index.json")
+
+# Labels and relationship types follow a colon in node and relationship patterns
+SCHEMA_NAME = re.compile(r":\s*`?([A-Za-z_]\w*)")
+
+def mentioned_types(cypher: str):
+    return {name for part in STRING_LITERAL.split(cypher)[::2] for name in SCHEMA_NAME.findall(part)}
+
+def file_hash(path: str):
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def build_index(examples: list):
+    # TF-IDF vectors of the content words of the example questions, normalised to unit length
+    terms = [question_terms(normalise_question(example["question"])) for example in examples]
+    document_frequency = Counter(term for counts in terms for term in counts)
+    idf = {term: math.log((len(examples) + 1) / (1 + frequency)) + 1 for term, frequency in document_frequency.items()}
+    vectors = []
+    for counts in terms:
+        vector = {term: count * idf[term] for term, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        vectors.append({term: weight / norm for term, weight in vector.items()})
+    return {"idf": idf, "vectors": vectors, "types": [sorted(mentioned_types(example["cypher"])) for example in examples]}
+
+
+class ExampleStore:
+    # Example questions with their Cypher, read from examples_path, and a similarity index
+    # over the questions. The index is built offline into index_path and rebuilt in memory
+    # when it is missing or older than the examples file.
+
+    def __init__(self, examples_path=EXAMPLES_PATH, index_path=INDEX_PATH):
+        with open(examples_path, "r") as file:
+            self.examples = yaml.safe_load(file)
+        digest = file_hash(examples_path)
+        index = None
+        if os.path.exists(index_path):
+            with open(index_path, "r") as file:
+                index = json.load(file)
+        if index is None or index.get("examples_hash") != digest:
+            print(f"The example index {index_path} is missing or stale, building it in memory")
+            index = build_index(self.examples)
+        self.idf = index["idf"]
+        self.vectors = index["vectors"]
+        self.types = [set(types) for types in index["types"]]
+
+    def select(self, question: str, k: int, available_types=None):
+        # Returns the k examples most similar to the question. Examples requiring labels or
+        # relationship types missing from available_types, or excluding ones in it, are
+        # skipped, and an available example replaces the others asked with the same question
+        query = {term: count * self.idf.get(term, 0.0) for term, count in question_terms(normalise_question(question)).items()}
+        norm = math.sqrt(sum(weight * weight for weight in query.values())) or 1.0
+        candidates = {}
+        for index, example in enumerate(self.examples):
+            requires = example.get("requires", [])
+            if available_types is not None and (not set(requires) <= available_types
+                                                or set(example.get("excludes", [])) & available_types):
+                continue
+            key = normalise_question(example["question"])
+            if key in candidates and not requires:
+                continue
+            score = sum(weight / norm * self.vectors[index].get(term, 0.0) for term, weight in query.items())
+            candidates[key] = (score, index)
+        ranked = sorted(candidates.values(), key=lambda candidate: -candidate[0])[:k]
+        return [{**self.examples[index], "similarity": round(score, 3), "types": self.types[index]} for score, index in ranked]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Builds the similarity index of the example questions")
+    parser.add_argument("--examples", default=EXAMPLES_PATH)
+    parser.add_argument("--index", default=INDEX_PATH)
+    args = parser.parse_args()
+    with open(args.examples, "r") as file:
+        examples = yaml.safe_load(file)
+    index = {"examples_hash": file_hash(args.examples), **build_index(examples)}
+    with open(args.index, "w") as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+    print(f"Indexed {len(examples)} examples in {args.index}")
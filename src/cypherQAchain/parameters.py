@@ -0,0 +1,95 @@
+import re
+import threading
+from collections import OrderedDict
+
+# Tokens of a statement that matter for parameterisation. Strings and numbers become
+# parameters and comments are dropped. Quoted names, existing parameters and identifiers
+# such as p1 are kept, and so are the bounds of variable length relationships, which cannot
+# be parameters. A * is only a bound inside a relationship pattern, elsewhere it multiplies
+TOKEN = re.compile(r"""
+    (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    |(?P<comment>//[^\n]*)
+    |(?P<quoted>`[^`]*`)
+    |(?P<parameter>\$\w+)
+    |(?P<bounds>\[\s*\w*\s*(?::\s*[\w|:`]+\s*)?\*\s*\d*\s*(?:\.\.\s*\d*)?)
+    |(?P<word>[A-Za-z_]\w*)
+    |(?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+""", re.VERBOSE)
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+
+def unescape(literal: str):
+    return re.sub(r"\\(.)", lambda m: ESCAPES.get(m.group(1), m.group(1)), literal[1:-1])
+
+def parameterise(cypher: str):
+    # Returns the statement with its literals replaced by parameters, with whitespace
+    # normalised, and the parameter values. A value used twice is the same parameter
+    params = {}
+    names = {}
+
+    def replace(match):
+        if match.lastgroup == "comment":
+            return ""
+        if match.lastgroup == "string":
+            value = unescape(match.group())
+        elif match.lastgroup == "number":
+            text = match.group()
+            value = float(text) if any(c in text for c in ".eE") else int(text)
+        else:
+            return match.group()
+        key = (type(value).__name__, value)
+        if key not in names:
+            names[key] = f"p{len(names)}"
+            params[names[key]] = value
+        return f"${names[key]}"
+
+    # No literal is left, so whitespace is collapsed everywhere
+    return " ".join(TOKEN.sub(replace, cypher).split()).rstrip(";").rstrip(), params
+
+
+class PlanCacheTracker:
+    # Statements run on Neo4j as the server plan cache sees them. A statement is expected
+    # to hit the plan cache when its text ran before and is among the capacity most recent
+    # texts, as the server cache is an LRU of query_cache_size entries. The same is counted
+    # for the statements as generated, to show the hits gained by parameterisation.
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.stats = {"executions": 0, "hits": 0, "literal_hits": 0}
+        self.__texts = OrderedDict()
+        self.__literal_texts = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __seen(self, texts: OrderedDict, text: str):
+        hit = text in texts
+        texts[text] = True
+        texts.move_to_end(text)
+        while len(texts) > self.capacity:
+            texts.popitem(last=False)
+        return hit
+
+    def record(self, cypher: str, text: str):
+        with self.__lock:
+            self.stats["executions"] += 1
+            self.stats["hits"] += self.__seen(self.__texts, text)
+            self.stats["literal_hits"] += self.__seen(self.__literal_texts, " ".join(cypher.split()))
+
+    def summary(self):
+        with self.__lock:
+            executions = self.stats["executions"]
+            return {"executions": executions, "distinct_statements": len(self.__texts),
+                    "hit_rate": round(self.stats["hits"] / executions, 3) if executions else None,
+                    "hit_rate_without_parameters": round(self.stats["literal_hits"] / executions, 3) if executions else None}
+
+
+if __name__ == "__main__":
+    # Regression cases, run with python -m cypherQAchain.parameters
+    cases = [
+        ("MATCH (m:Parameter) RETURN m.Value * 2.5 AS x", "MATCH (m:Parameter) RETURN m.Value * $p0 AS x", {"p0": 2.5}),
+        ("MATCH (a)-[*1..3]->(b) RETURN a", "MATCH (a)-[*1..3]->(b) RETURN a", {}),
+        ("MATCH (a)-[r:T|U*2]->(b) RETURN count(*) * 100.0", "MATCH (a)-[r:T|U*2]->(b) RETURN count(*) * $p0", {"p0": 100.0}),
+        ("MATCH (p {USUBJID: '01-701'}) RETURN 3*4 LIMIT 3", "MATCH (p {USUBJID: $p0}) RETURN $p1*$p2 LIMIT $p1",
+         {"p0": "01-701", "p1": 3, "p2": 4}),
+    ]
+    for cypher, text, params in cases:
+        assert parameterise(cypher) == (text, params), (cypher, parameterise(cypher))
+    print(f"{len(cases)} cases passed")
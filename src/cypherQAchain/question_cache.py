@@ -0,0 +1,162 @@
+import math
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+# Literals such as visit weeks, patient identifiers or quoted values change the generated
+# Cypher, so two questions only match as near duplicates when they share all of them
+LITERAL = re.compile(r"\d[\w\-.]*|'[^']*'|\"[^\"]*\"")
+
+def normalise_question(question: str):
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = re.sub(r"[^\w\s\-.'\"]", " ", text)
+    text = re.sub(r"(?<!\d)[.\-](?!\d)", " ", text)
+    return " ".join(text.split())
+
+# Wording that does not change the Cypher asked for
+FILLER_WORDS = {"a", "an", "the", "of", "for", "in", "at", "on", "to", "by", "with", "and", "me", "i", "we", "you",
+                "please", "can", "could", "would", "give", "show", "list", "get", "tell", "need", "want", "what", "which",
+                "is", "are", "was", "were", "be", "been", "do", "does", "did", "there", "their", "its", "each", "every",
+                "all", "table", "tabular", "format", "as", "that", "this", "these", "those"}
+
+# Content words that only rephrase what is asked for, such as "sodium levels" and "sodium
+# values". Near duplicates may differ in them, any other differing word names another
+# entity or operation and changes the Cypher. They weigh WORDING_WEIGHT in the similarity
+WORDING_WORDS = {"value", "level", "measurement", "measure", "measured", "reading", "result", "record", "recorded",
+                 "data", "information", "detail", "find", "display", "provide", "return", "retrieve", "fetch",
+                 "know", "see", "like", "about", "observed", "obtained", "current", "respective"}
+WORDING_WEIGHT = 0.5
+
+def question_terms(normalised: str):
+    # Content words with a plural s removed
+    words = [word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+             for word in normalised.split() if word not in FILLER_WORDS]
+    return Counter(words)
+
+
+class QuestionCache:
+    # Two-tier cache from questions to the Cypher generated for them. The first tier is an
+    # exact match on the normalised question. The second tier is a TF-IDF index over the
+    # content words of the cached questions that matches near duplicates above
+    # similarity_threshold. Both questions must have the same literals and may only differ
+    # in filler and wording words, so that "sodium" never matches "potassium". Entries
+    # are evicted least recently used first beyond max_entries and after ttl seconds, and
+    # are persisted in a SQLite file so the cache survives restarts.
+
+    def __init__(self, path, max_entries=1000, ttl=7 * 24 * 3600, similarity_threshold=0.8):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0}
+        self.__entries = OrderedDict()
+        self.__terms = {}
+        self.__document_frequency = Counter()
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("""
+            CREATE TABLE IF NOT EXISTS question_cache (
+                normalised TEXT PRIMARY KEY,
+                question TEXT NOT NULL,
+                cypher TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.__connection.commit()
+        rows = self.__connection.execute(
+            "SELECT normalised, question, cypher, created, last_used FROM question_cache ORDER BY last_used").fetchall()
+        for normalised, question, cypher, created, last_used in rows:
+            self.__add(normalised, {"question": question, "cypher": cypher, "created": created, "last_used": last_used})
+        with self.__lock:
+            self.__evict(time.time())
+
+    def __add(self, normalised, entry):
+        if normalised in self.__entries:
+            self.__remove(normalised)
+        self.__entries[normalised] = entry
+        self.__terms[normalised] = question_terms(normalised)
+        self.__document_frequency.update(self.__terms[normalised].keys())
+
+    def __remove(self, normalised):
+        del self.__entries[normalised]
+        self.__document_frequency.subtract(self.__terms.pop(normalised).keys())
+        self.__connection.execute("DELETE FROM question_cache WHERE normalised = ?", (normalised,))
+
+    def __evict(self, now):
+        expired = [normalised for normalised, entry in self.__entries.items() if now - entry["created"] > self.ttl]
+        overflow = max(0, len(self.__entries) - len(expired) - self.max_entries)
+        lru = [normalised for normalised in self.__entries if normalised not in expired][:overflow]
+        for normalised in expired + lru:
+            self.__remove(normalised)
+        self.stats["evictions"] += len(expired) + len(lru)
+        self.__connection.commit()
+
+    def __vector(self, terms):
+        documents = len(self.__entries) + 1
+        vector = {term: count * (math.log(documents / (1 + self.__document_frequency[term])) + 1)
+                  * (WORDING_WEIGHT if term in WORDING_WORDS else 1.0) for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def __most_similar(self, normalised):
+        literals = sorted(LITERAL.findall(normalised))
+        query_terms = question_terms(normalised)
+        query = self.__vector(query_terms)
+        best, best_score = None, 0.0
+        for candidate, terms in self.__terms.items():
+            if sorted(LITERAL.findall(candidate)) != literals:
+                continue
+            # However often an entity word is cached, it is never interchangeable with another one
+            if any(term not in WORDING_WORDS for term in set(terms) ^ set(query_terms)):
+                continue
+            vector = self.__vector(terms)
+            score = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+            if score > best_score:
+                best, best_score = candidate, score
+        return best, best_score
+
+    def lookup(self, question: str):
+        # Returns the cached entry with how it matched, or None on a miss
+        normalised = normalise_question(question)
+        now = time.time()
+        with self.__lock:
+            self.__evict(now)
+            match, similarity, tier = normalised, 1.0, "exact"
+            if normalised not in self.__entries:
+                match, similarity = self.__most_similar(normalised)
+                tier = "similar"
+                if match is None or similarity < self.similarity_threshold:
+                    self.stats["misses"] += 1
+                    return None
+            self.stats[f"{tier}_hits"] += 1
+            entry = self.__entries[match]
+            entry["last_used"] = now
+            self.__entries.move_to_end(match)
+            self.__connection.execute("UPDATE question_cache SET last_used = ? WHERE normalised = ?", (now, match))
+            self.__connection.commit()
+            return {"question": entry["question"], "cypher": entry["cypher"], "tier": tier,
+                    "similarity": round(similarity, 3)}
+
+    def store(self, question: str, cypher: str):
+        normalised = normalise_question(question)
+        now = time.time()
+        with self.__lock:
+            self.__add(normalised, {"question": question, "cypher": cypher, "created": now, "last_used": now})
+            self.__connection.execute("INSERT OR REPLACE INTO question_cache VALUES (?, ?, ?, ?, ?)",
+                                      (normalised, question, cypher, now, now))
+            self.__evict(now)
+
+    def clear(self):
+        with self.__lock:
+            for normalised in list(self.__entries):
+                self.__remove(normalised)
+            self.__connection.commit()
+
+    def summary(self):
+        with self.__lock:
+            lookups = self.stats["exact_hits"] + self.stats["similar_hits"] + self.stats["misses"]
+            hits = self.stats["exact_hits"] + self.stats["similar_hits"]
+            return {**self.stats, "entries": len(self.__entries), "max_entries": self.max_entries,
+                    "hit_rate": round(hits / lookups, 3) if lookups else None}
@@ -0,0 +1,169 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from itertools import islice
+from neo4j import Query
+from langchain_community.graphs.graph_store import GraphStore
+from cypherQAchain.parameters import parameterise, PlanCacheTracker
+
+STRING_LITERAL = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")")
+WRITE_CLAUSE = re.compile(r"\b(CREATE|MERGE|DELETE|DETACH|SET|REMOVE|DROP|LOAD\s+CSV|FOREACH)\b", re.IGNORECASE)
+
+def normalise_cypher(cypher: str):
+    # Collapses whitespace outside string literals and drops a trailing semicolon
+    parts = STRING_LITERAL.split(cypher.strip().rstrip(";"))
+    return "".join(part if index % 2 else " ".join(part.split()) for index, part in enumerate(parts))
+
+def is_read_only(cypher: str):
+    parts = STRING_LITERAL.split(cypher)
+    return not any(WRITE_CLAUSE.search(part) for part in parts[::2])
+
+
+class ResultCache:
+    # Pages of results of read-only Cypher keyed by the normalised statement, the graph
+    # version stamp, the page bounds and the parameters, so a new load of the graph invalidates them. The cache is bounded to
+    # max_bytes of results measured by their JSON size. Least recently used results are
+    # evicted first and results larger than max_entry_bytes are not cached.
+
+    def __init__(self, max_bytes=64 * 1024 ** 2, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "uncacheable": 0}
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__version = None
+        self.__lock = threading.Lock()
+
+    def __remove(self, key):
+        _, size = self.__entries.pop(key)
+        self.__bytes -= size
+
+    def __set_version(self, version):
+        # Results of older versions of the graph can never be hit again
+        if version != self.__version:
+            for key in [key for key in self.__entries if key[1] != version]:
+                self.__remove(key)
+            self.__version = version
+
+    def get(self, cypher: str, version, skip=0, limit=None, params=None):
+        key = (normalise_cypher(cypher), version, skip, limit, json.dumps(params or {}, sort_keys=True, default=str))
+        with self.__lock:
+            self.__set_version(version)
+            if key not in self.__entries:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.__entries.move_to_end(key)
+            return list(self.__entries[key][0])
+
+    def put(self, cypher: str, version, rows: list, skip=0, limit=None, params=None):
+        size = len(json.dumps(rows, default=str))
+        key = (normalise_cypher(cypher), version, skip, limit, json.dumps(params or {}, sort_keys=True, default=str))
+        with self.__lock:
+            self.__set_version(version)
+            if size > self.max_entry_bytes:
+                self.stats["uncacheable"] += 1
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (rows, size)
+            self.__bytes += size
+            while self.__bytes > self.max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    def summary(self):
+        with self.__lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {**self.stats, "entries": len(self.__entries), "bytes": self.__bytes, "max_bytes": self.max_bytes,
+                    "graph_version": self.__version, "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else None}
+
+
+class CachedGraph(GraphStore):
+    # Graph given to the chain so that the Cypher it generates is answered from the result
+    # cache. Only the first page of page_size rows, plus one row telling whether there are
+    # more, is read for the chain. Records are pulled from the server fetch_size at a time,
+    # so later pages and exports never hold the whole result in memory. Literals are taken
+    # out of the statements into parameters, so that statements differing only in their
+    # values share one plan in the Neo4j plan cache and one key in the result cache. With
+    # a cost guard, statements run as rewritten by it and are rejected when their plan is
+    # over budget, write queries included. The schema methods go to the wrapped graph.
+
+    def __init__(self, graph, cache: ResultCache, version, page_size=100, fetch_size=1000, timeout=None, guard=None,
+                 plan_cache_size=1000):
+        self.graph = graph
+        self.cache = cache
+        self.version = version
+        self.page_size = page_size
+        self.fetch_size = fetch_size
+        self.timeout = timeout
+        self.guard = guard
+        self.plan_cache = PlanCacheTracker(plan_cache_size)
+
+    @property
+    def get_schema(self):
+        return self.graph.get_schema
+
+    @property
+    def get_structured_schema(self):
+        return self.graph.get_structured_schema
+
+    @property
+    def structured_schema(self):
+        return self.graph.structured_schema
+
+    def refresh_schema(self):
+        self.graph.refresh_schema()
+
+    def add_graph_documents(self, graph_documents, include_source=False):
+        self.graph.add_graph_documents(graph_documents, include_source)
+
+    def plan(self, cypher: str, cap_rows=True):
+        # Returns the statement to run, parameterised and rewritten by the cost guard, with its parameters
+        text, params = parameterise(cypher)
+        if self.guard is not None:
+            text = self.guard.check(self.graph, text, self.version(), params, cap_rows)["cypher"]
+        return text, params
+
+    def plan_summary(self):
+        # Planning time is measured by the EXPLAIN of the cost guard, run once per statement
+        summary = self.plan_cache.summary()
+        if self.guard is not None:
+            planned = self.guard.stats["checked"]
+            summary.update(planned=planned,
+                           mean_planning_ms=round(self.guard.stats["planning_ms"] / planned, 2) if planned else None)
+        return summary
+
+    def stream(self, cypher: str, skip=0, cap_rows=True):
+        # Generator of the result records as dicts starting at row skip. Without cap_rows
+        # the cost guard does not limit the rows, for exports of the full result
+        text, params = self.plan(cypher, cap_rows)
+        self.plan_cache.record(cypher, text)
+        with self.graph._driver.session(database=self.graph._database, fetch_size=self.fetch_size) as session:
+            result = session.run(Query(text, timeout=self.timeout), params)
+            for record in islice(result, skip, None):
+                yield record.data()
+
+    def page(self, cypher: str, skip: int, limit: int):
+        version = self.version()
+        text, params = parameterise(cypher)
+        rows = self.cache.get(text, version, skip, limit, params)
+        if rows is None:
+            with closing(self.stream(cypher, skip)) as records:
+                rows = list(islice(records, limit))
+            self.cache.put(text, version, rows, skip, limit, params)
+        return rows
+
+    def query(self, query: str, params: dict = {}):
+        if params or not is_read_only(query):
+            if self.guard is not None:
+                query = self.guard.check(self.graph, query, self.version(), params, is_read_only(query))["cypher"]
+            return self.graph.query(query, params)
+        return self.page(query, 0, self.page_size + 1)
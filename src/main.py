@@ -1,25 +1,192 @@
-from fastapi import FastAPI
-from cypherQAchain.cypher_chain import graph_chain
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from cypherQAchain.cypher_chain import service, generated_cypher
+from cypherQAchain.question_cache import QuestionCache, normalise_question
+from cypherQAchain.admission import QuestionGate, Overloaded
+from cypherQAchain.cursors import CursorCodec
+from cypherQAchain.cost_guard import CostRejected
 import pandas as pd
+import asyncio
 import json
+import csv
+import io
+import os
 from pydantic import BaseModel
 
 class Query(BaseModel):
     question: str
 
+# Questions already answered, or near duplicates of them, reuse the Cypher generated for them
+question_cache = QuestionCache(os.getenv("QUESTION_CACHE_PATH", "./question_cache.sqlite"),
+                               max_entries=int(os.getenv("QUESTION_CACHE_SIZE", 1000)),
+                               ttl=float(os.getenv("QUESTION_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+                               similarity_threshold=float(os.getenv("QUESTION_CACHE_SIMILARITY", 0.8)))
+
+# Questions run on a bounded pool of workers off the event loop
+question_gate = QuestionGate(workers=int(os.getenv("QA_WORKERS", 4)),
+                             max_queue=int(os.getenv("QA_MAX_QUEUE", 16)),
+                             queue_timeout=float(os.getenv("QUEUE_TIMEOUT_SECONDS", 10)),
+                             request_timeout=float(os.getenv("REQUEST_TIMEOUT_SECONDS", 90)))
+
+# Further pages and exports of an answer are requested with signed cursors
+cursors = CursorCodec(os.getenv("CURSOR_SECRET"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm-up: connect to Neo4j, introspect the schema and build the chain before serving requests.
+    # When Neo4j is not reachable yet the service starts anyway and retries on the first question
+    try:
+        await asyncio.to_thread(service.start)
+    except Exception as e:
+        print("Warm-up failed:", e)
+    yield
+    question_gate.close()
+    service.close()
+
 app = FastAPI(
     title="Clinical Trial Cypher Agent",
     description="Endpoints for a AI agent that translate natural language to Cypher queries",
+    lifespan=lifespan,
 )
 
+def check_admin_token(token):
+    # Admin endpoints are open unless ADMIN_TOKEN is set
+    if os.getenv("ADMIN_TOKEN") and token != os.getenv("ADMIN_TOKEN"):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
 @app.get("/")
 async def get_status():
-    return {"status": "running"}
+    return {"status": "running" if service.ready else "starting", "schema": service.status(),
+            "workers": question_gate.summary(), "cost_guard": service.guard.summary() if service.guard else None}
+
+@app.post("/admin/refresh-schema")
+async def refresh_schema(x_admin_token: str = Header(default=None)):
+    check_admin_token(x_admin_token)
+    return await asyncio.to_thread(service.refresh_schema)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"questions": question_cache.summary(), "results": service.result_cache.summary(),
+            "plans": service.cached_graph.plan_summary() if service.cached_graph else None}
+
+@app.delete("/admin/cache")
+async def clear_caches(x_admin_token: str = Header(default=None)):
+    check_admin_token(x_admin_token)
+    question_cache.clear()
+    service.result_cache.clear()
+    return await cache_stats()
+
+def paginate(response: dict):
+    # The answer holds the first page of the result, cursors point to the next page and the full export
+    cypher = generated_cypher(response)
+    if not cypher:
+        return response
+    response["plan"] = service.plan_cost(cypher)
+    print("Plan cost:", response["plan"])
+    _, more = service.page(cypher, 0, service.page_size)
+    response["page"] = {"size": service.page_size,
+                        "next_cursor": cursors.encode(cypher, service.version, service.page_size) if more else None,
+                        "export_cursor": cursors.encode(cypher, service.version, 0)}
+    return response
+
+def answer_question(question: str):
+    # Runs on a worker thread
+    cached = question_cache.lookup(question)
+    if cached is not None:
+        response = service.run_cypher(question, cached["cypher"])
+        response["cache"] = cached
+        return paginate(response)
+    response = service.ask(question)
+    # Only Cypher that ran without errors gets here. The corrector returns no Cypher for invalid schemas
+    if generated_cypher(response):
+        question_cache.store(question, generated_cypher(response))
+    return paginate(response)
 
 @app.post("/graph-question")
 async def query_clinical_graph(query: Query):
     print(query.question)
-    query_response = await graph_chain(query.question)
-    return query_response
+    if not service.ready:
+        try:
+            await asyncio.to_thread(service.start)
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Graph database not available: {e}", headers={"Retry-After": "10"})
+    try:
+        return await question_gate.run(normalise_question(query.question), answer_question, query.question)
+    except CostRejected as e:
+        raise HTTPException(status_code=422, detail={"message": e.detail, "plan": e.cost})
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The question took too long to answer")
+
+def open_cursor(cursor: str, cap_rows=True):
+    try:
+        position = cursors.decode(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Rows of another load of the graph would not line up with the pages already read
+    service.current_schema()
+    if position["version"] != service.version:
+        raise HTTPException(status_code=410, detail="The graph was reloaded since this answer, ask the question again")
+    try:
+        service.plan_cost(position["cypher"], cap_rows)
+    except CostRejected as e:
+        raise HTTPException(status_code=422, detail={"message": e.detail, "plan": e.cost})
+    return position
+
+def next_page(position: dict, page_size: int):
+    rows, more = service.page(position["cypher"], position["skip"], page_size)
+    next_skip = position["skip"] + page_size
+    return {"result": rows, "skip": position["skip"],
+            "next_cursor": cursors.encode(position["cypher"], position["version"], next_skip) if more else None}
+
+@app.get("/results/{cursor}")
+async def result_page(cursor: str, page_size: int = None):
+    page_size = min(max(page_size or service.page_size, 1), MAX_PAGE_SIZE)
+    position = await asyncio.to_thread(open_cursor, cursor)
+    try:
+        return await question_gate.run(("page", cursor, page_size), next_page, position, page_size)
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The page took too long to read")
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record, default=str) + "\n"
+
+def csv_lines(records):
+    # The header is taken from the first record, as the columns of a Cypher result are the same in every row
+    buffer = io.StringIO()
+    writer = None
+    for record in records:
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(record), extrasaction="ignore")
+            writer.writeheader()
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+@app.get("/results/{cursor}/export")
+async def export_result(cursor: str, format: str = "ndjson"):
+    # Streams every row of the result without holding it in memory
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    # Exports are checked without the row cap of the cost guard, so every row is sent
+    position = await asyncio.to_thread(open_cursor, cursor, False)
+    records = service.stream(position["cypher"])
+    lines = csv_lines(records) if format == "csv" else ndjson_lines(records)
+    # The rows are read on the workers of the question gate, which holds a slot for the whole export
+    try:
+        lines = await question_gate.stream(lines)
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    if format == "csv":
+        return StreamingResponse(lines, media_type="text/csv",
+                                 headers={"Content-Disposition": "attachment; filename=query_result.csv"})
+    return StreamingResponse(lines, media_type="application/x-ndjson")
 
-# run the FastAPI with command: uvicorn main:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+# run the FastAPI with command: uvicorn main:app --host 0.0.0.0 --port 8000